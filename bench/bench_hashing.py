@@ -0,0 +1,57 @@
+'''
+file digest benchmark
+
+compares checking both the md5sum and sha256sum of a large binary the way
+testinfra does it (an md5sum and a sha256sum subprocess, each reading the
+whole file) against infratest's in-process digests, which read it once.
+
+usage: python bench/bench_hashing.py [size in MiB] [rounds]
+'''
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import infratest
+
+
+def _subprocesses(path):
+    for command in ('md5sum', 'sha256sum'):
+        subprocess.check_output([command, path])
+
+
+def _in_process(path):
+    facts = infratest._Facts()
+    facts.want_digest(path, 'md5')
+    facts.want_digest(path, 'sha256')
+    facts.digest(path, 'md5')
+    facts.digest(path, 'sha256')
+
+
+def main(size=512, rounds=3):
+    handle, path = tempfile.mkstemp(prefix='infratest-bench-')
+    try:
+        block = os.urandom(1024 * 1024)
+        with os.fdopen(handle, 'wb') as out:
+            for _ in range(size):
+                out.write(block)
+        print('file size:    {0} MiB'.format(size))
+        for name, func in (('subprocess', _subprocesses),
+                           ('in process', _in_process)):
+            best = min(timeit.repeat(lambda: func(path), repeat=rounds, number=1))
+            print('{0}:   {1:8.3f} s {2:8.1f} MiB/s'.format(name, best, size / best))
+        digests = infratest._digests(path, ['md5', 'sha256'])
+        with open(path, 'rb') as check:
+            data = check.read()
+        assert digests['md5'] == hashlib.md5(data).hexdigest()
+        assert digests['sha256'] == hashlib.sha256(data).hexdigest()
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,39 @@
+'''
+loader-time benchmark
+
+measures how long a fresh interpreter takes to import infratest, compared to
+one that only imports logging (which the salt loader always has loaded), and
+confirms that no testinfra host has been created by the import.
+
+usage: python bench/bench_import.py [rounds]
+'''
+import os
+import subprocess
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASELINE = 'import logging'
+IMPORT = 'import infratest; assert infratest._HOST is None'
+
+
+def _time(statement, rounds):
+    cmd = [sys.executable, '-c', statement]
+    # a minion imports from cached bytecode, so let the first round write it
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    timer = timeit.Timer(lambda: subprocess.check_call(cmd, cwd=ROOT, env=env))
+    return min(timer.repeat(repeat=rounds, number=1))
+
+
+def main(rounds=10):
+    base = _time(BASELINE, rounds)
+    loaded = _time(IMPORT, rounds)
+    print('import logging:     {0:8.2f} ms'.format(base * 1000))
+    print('import infratest:   {0:8.2f} ms'.format(loaded * 1000))
+    print('import cost:        {0:8.2f} ms'.format((loaded - base) * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,245 @@
+'''
+run_all benchmark
+
+runs run_all over synthetic infratest pillars against a temporary fixture
+tree, with the dpkg-query and systemctl output stubbed, so it needs no
+network, packages or running services:
+
+    files       10000 files, each checked for exists, type, mode and user
+    packages    1000 packages, checked for installed and version
+    services    500 services, checked for running and enabled
+    contains    4 large files, each searched for 5 patterns
+    all         all of the above in one run
+
+each scenario reports checks/sec (best of rounds) and the peak memory
+allocated by a run. --save stores the results as the baseline, later runs
+compare against it and exit 1 when a scenario got slower or bigger than
+--tolerance allows.
+
+checks/sec depend on the machine, so no baseline is kept in the repository.
+run with --save first on the machine doing the comparison (on the commit to
+compare against), a run without a baseline exits 2.
+
+usage: python bench/bench_run_all.py [--scale 0.1] [--contains-mib 64]
+                                     [--rounds 3] [--workers 1]
+                                     [--baseline bench/baseline.json]
+                                     [--save] [--tolerance 0.25]
+'''
+import argparse
+import json
+import os
+import pwd
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import infratest  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+LINE = b'option_%07d = value for line %07d of a large configuration file\n'
+
+
+def _fixture_tree(root, files, large, large_mib):
+    '''
+    create files small files and large files of large_mib MiB under root
+    '''
+    for index in range(files):
+        directory = os.path.join(root, 'etc', 'd{0:03d}'.format(index // 100))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, 'f{0:05d}.conf'.format(index))
+        with open(path, 'w') as out:
+            out.write('setting = {0}\n'.format(index))
+        os.chmod(path, 0o644 if index % 10 else 0o600)
+    for index in range(large):
+        path = os.path.join(root, 'large{0}.log'.format(index))
+        with open(path, 'wb') as out:
+            lines = (large_mib * 1024 * 1024) // len(LINE % (0, 0))
+            for start in range(0, lines, 10000):
+                out.write(b''.join(LINE % (line, line) for line in
+                                   range(start, min(start + 10000, lines))))
+
+
+def _file_pillar(root, files):
+    user = pwd.getpwuid(os.getuid()).pw_name
+    pillar = {}
+    for index in range(files):
+        path = os.path.join(root, 'etc', 'd{0:03d}'.format(index // 100),
+                            'f{0:05d}.conf'.format(index))
+        pillar[path] = {'exists': True, 'type': 'file',
+                        'mode': '0644' if index % 10 else '0600', 'user': user}
+    return pillar
+
+
+def _contains_pillar(root, large):
+    patterns = ['^option_0000000 ', 'line 0000500 of', 'large configuration',
+                '^option_9999999 ', 'not in the file']
+    return dict((os.path.join(root, 'large{0}.log'.format(index)),
+                 {'contains': patterns}) for index in range(large))
+
+
+def _package_pillar(packages):
+    return dict(('pkg{0}'.format(index),
+                 {'installed': True, 'version': '1.{0}-1'.format(index)})
+                for index in range(packages))
+
+
+def _service_pillar(services):
+    return dict(('svc{0}'.format(index), {'running': True, 'enabled': True})
+                for index in range(services))
+
+
+def _stub_command(packages, services):
+    '''
+    return a _command stand-in answering dpkg-query and systemctl listings
+    '''
+    outputs = {
+        'dpkg-query': ''.join(
+            'pkg{0}\tamd64\tinstall ok installed\t1.{0}-1\n'.format(index)
+            for index in range(packages * 2)),
+        'list-units': ''.join(
+            'svc{0}.service loaded active running Service {0}\n'.format(index)
+            for index in range(services * 2)),
+        'list-unit-files': ''.join(
+            'svc{0}.service enabled\n'.format(index)
+            for index in range(services * 2)),
+    }
+
+    def command(*args):
+        if args[0] == 'dpkg-query':
+            return outputs['dpkg-query']
+        if args[0] == 'systemctl' and args[1] in outputs:
+            return outputs[args[1]]
+        return None
+    return command
+
+
+def _run(pillar, workers):
+    infratest.__salt__ = {'pillar.get': lambda key: pillar,
+                          'config.get': lambda key, default: default}
+    try:
+        return infratest.run_all(workers=workers)
+    finally:
+        del infratest.__salt__
+
+
+def _measure(pillar, failures, rounds, workers):
+    '''
+    return (checks, best seconds, peak bytes) of run_all over pillar, which
+    should fail failures checks
+    '''
+    totals = _run(pillar, workers)
+    checks = totals['Pass'] + totals['Fail']
+    assert totals['Fail'] == failures, totals
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        _run(pillar, workers)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    _run(pillar, workers)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return checks, best, peak
+
+
+def _compare(results, baseline, tolerance):
+    '''
+    return the regressions of results against baseline
+    '''
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        speed, was = result['checks_per_sec'], before['checks_per_sec']
+        if speed < was * (1 - tolerance):
+            regressions.append('{0}: {1:.0f} checks/s, baseline {2:.0f}'
+                               .format(name, speed, was))
+        if result['peak_bytes'] > before['peak_bytes'] * (1 + tolerance):
+            regressions.append('{0}: peak {1} bytes, baseline {2}'.format(
+                name, result['peak_bytes'], before['peak_bytes']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark run_all')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the number of files, packages and '
+                             'services')
+    parser.add_argument('--contains-mib', type=int, default=64,
+                        help='size of each large file searched by contains')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--baseline',
+                        default=os.path.join(HERE, 'baseline.json'))
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown or memory growth, 0.25 = 25%%')
+    args = parser.parse_args()
+
+    files = int(10000 * args.scale)
+    packages = int(1000 * args.scale)
+    services = int(500 * args.scale)
+    large = 4
+
+    root = tempfile.mkdtemp(prefix='infratest-bench-')
+    command = infratest._command
+    try:
+        _fixture_tree(root, files, large, args.contains_mib)
+        infratest._command = _stub_command(packages, services)
+        # two of the five contains patterns are not in the large files
+        scenarios = [
+            ('files', {'file': _file_pillar(root, files)}, 0),
+            ('packages', {'package': _package_pillar(packages)}, 0),
+            ('services', {'service': _service_pillar(services)}, 0),
+            ('contains', {'file': _contains_pillar(root, large)}, 2 * large),
+        ]
+        everything = {}
+        for _, pillar, _ in scenarios:
+            for section, tests in pillar.items():
+                everything.setdefault(section, {}).update(tests)
+        scenarios.append(('all', everything, 2 * large))
+
+        results = {}
+        for name, pillar, failures in scenarios:
+            checks, seconds, peak = _measure(pillar, failures, args.rounds,
+                                             args.workers)
+            results[name] = {'checks': checks, 'seconds': seconds,
+                             'checks_per_sec': checks / seconds,
+                             'peak_bytes': peak}
+            print('{0:10} {1:7d} checks {2:9.3f} s {3:11.0f} checks/s '
+                  '{4:9.1f} MiB peak'.format(name, checks, seconds,
+                                             checks / seconds,
+                                             peak / 1048576.0))
+    finally:
+        infratest._command = command
+        shutil.rmtree(root)
+
+    if args.save:
+        with open(args.baseline, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+        print('baseline saved to {0}'.format(args.baseline))
+        return 0
+    try:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+    except EnvironmentError:
+        print('no baseline at {0}, run with --save to store one'.format(
+            args.baseline), file=sys.stderr)
+        return 2
+    regressions = _compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,34 +10,1174 @@ created by: Brett Taylor <sweet.brett@gmail.com>
 documentation for the main python project: http://testinfra.readthedocs.org/
 '''
 
+import binascii
+import collections
+import datetime
+import fnmatch
+import grp
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pwd
+import re
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
 try:
-    import testinfra
-    HAS_TESTINFRA = True
+    from importlib.util import find_spec
 except ImportError:
-    HAS_TESTINFRA = False
+    from pkgutil import find_loader as find_spec
 
-import logging
+# testinfra itself is only imported by _host(), importing it here would make
+# every loader pass pay for it. the same goes for concurrent.futures, which
+# is only needed by runs with more than one worker
+HAS_TESTINFRA = find_spec('testinfra') is not None
+HAS_FUTURES = find_spec('concurrent.futures') is not None
 
 LOG = logging.getLogger(__name__)
 
 __virtualname__ = 'infratest'
 
-conn = testinfra.get_host('local://')
-File = conn.file
-Package = conn.package
-Service = conn.service
-Socket = conn.socket
-Process = conn.process
-Group = conn.group
-User = conn.user
-Interface = conn.interface
-SystemInfo = conn.system_info
-Sysctl = conn.sysctl
-Mount = conn.mount_point
+# testinfra host handle, created on first use by _host() so that loading
+# the module (saltutil.sync_modules, minion loader passes) stays cheap
+_HOST = None
+_HOST_LOCK = threading.Lock()
+
+# root of the proc filesystem read by the socket, process, mount and
+# sysctl tables
+_PROC = '/proc'
+
+# root of the sysfs read for the interface checks
+_SYS = '/sys'
+
+# package databases, account databases and systemd unit directories whose
+# timestamps fingerprint the inputs of package, user, group and service
+# checks in incremental runs
+_PACKAGE_DBS = ('/var/lib/dpkg/status', '/var/lib/rpm/Packages',
+                '/var/lib/rpm/rpmdb.sqlite',
+                '/usr/lib/sysimage/rpm/rpmdb.sqlite')
+_ACCOUNT_DBS = ('/etc/passwd', '/etc/group')
+_NSSWITCH = '/etc/nsswitch.conf'
+
+# name service sources that only read the local account databases
+_LOCAL_SOURCES = ('files', 'compat')
+_UNIT_DIRS = ('/etc/systemd/system', '/run/systemd/system',
+              '/lib/systemd/system', '/usr/lib/systemd/system')
+
+# files are read for file_contains and the digests in chunks of this size
+_CHUNK_SIZE = 4 * 1024 * 1024
+
+# a line longer than a chunk is searched in windows overlapping by this
+# much, a match spanning more of such a line than this may be missed
+_LINE_OVERLAP = 64 * 1024
+
+# per thread: the _CheckProfile of the check the thread runs while
+# run_all(profile=True) is going, counted into by _command and the readers
+_PROFILING = threading.local()
+
+# per thread: when the check the thread runs under run_all deadlines has to
+# be done by, commands still running then are killed by _command
+_DEADLINE = threading.local()
+
+# digests of files modified this recently are not written to the digest
+# cache, a change within the same mtime tick would go unnoticed
+_RACY_SECONDS = 2
+
+
+# check kind => (message, found), message is formatted with the target and
+# the expected value and found, if any, appended with the found value when
+# the check failed. a callable message is given the whole _Result instead
+_MESSAGES = {
+    'file_exists': ('{0} exists: {1}', None),
+    'file_isfile': ('{0} is: {1}', None),
+    'file_isdir': ('{0} is: {1}', None),
+    'file_ispipe': ('{0} is: {1}', None),
+    'file_issocket': ('{0} is: {1}', None),
+    'file_issymlink': ('{0} is: {1}', None),
+    'file_badtype': ('{0} could not find a type match: {1}', None),
+    'file_linkedto': ('{0} is linked to: {1}', ', found: {}'),
+    'file_user': ('{0} is owned by user: {1}', ', found: {}'),
+    'file_group': ('{0} is owned by group: {1}', ', found {}'),
+    'file_uid': ('{0} is owned by uid: {1}', ', found: {}'),
+    'file_gid': ('{0} is owned by gid: {1}', ', found: {}'),
+    'file_mode': ('{0} has mode: {1}', ', found: {}'),
+    'file_contains': ('{0} contains: {1}', None),
+    'file_md5sum': ('{0} has md5sum: {1}', ', found: {}'),
+    'file_sha256sum': ('{0} has sha256sum: {1}', ', found: {}'),
+    'file_mtime': ('{0} has mtime: {1}', None),
+    'file_size': ('{0} has size: {1}', ', found: {}'),
+    'package_isinstalled': ('{0} is installed: {1}', None),
+    'package_version': ('{0} is version: {1}', ', found: {}'),
+    'process_count': ('{0[0]} has {1} processes running owned by {0[1]}',
+                      ', found: {}'),
+    'service_isrunning': ('{0} is running: {1}', None),
+    'service_isvalid': ('{0} is valid: {1}', None),
+    'service_isenabled': ('{0} is enabled: {1}', None),
+    'socket_islistening': ('{0} is listening: {1}', None),
+    'user_exists': ('{0} exists: {1}', None),
+    'user_uid': ('{0} has uid: {1}', ', found: {}'),
+    'user_gid': ('{0} has gid: {1}', ', found: {}'),
+    'user_group': ('{0} has group: {1}', None),
+    'user_gids': ('{0} has gids: {1}', ', found: {}'),
+    'user_groups': ('{0} has groups: {1}', ', found: {}'),
+    'user_home': ('{0} has home: {1}', ', found: {}'),
+    'user_shell': ('{0} has shell: {1}', ', found: {}'),
+    'group_exists': ('{0} exists: {1}', None),
+    'group_gid': ('{0} has gid: {1}', ', found: {}'),
+    'interface_exists': ('{0} exists: {1}', None),
+    'interface_speed': ('{0} has speed: {1}', ', found: {}'),
+    'interface_address': ('{0} has address: {1}', ', found: {}'),
+    'systeminfo_type': ('type: {1}', ', found: {}'),
+    'systeminfo_distribution': ('distribution: {1}', ', found: {}'),
+    'systeminfo_release': ('release: {1}', ', found: {}'),
+    'systeminfo_codename': ('codename: {1}', ', found: {}'),
+    'sysctl': ('{0}: {1}', ', found: {}'),
+    'sysctl_invalid': ('{0} is not a valid sysctl setting', None),
+    'mount_exists': ('{0} mount exists: {1}', None),
+    'mount_filesystem': ('{0} has {1} file system.', ', found: {}'),
+    'mount_device': ('{0} is mounted to {1} device.', ', found: {}'),
+    'mount_options': (lambda result: '{0} has {1}'.format(
+        result.target, ','.join(result.expected)) + (
+            '' if result.ok else ', found: {}'.format(
+                result.found and ','.join(result.found))), None),
+    'check_timeout': (lambda result: (
+        '{0} timed out, run budget used up' if result.expected is None else
+        '{0} timed out after {1} seconds').format(
+            result.target, result.expected), None),
+    'check_skipped': ('{0} not run, run budget used up', None),
+    'baseline_unchanged': ('{0} unchanged', None),
+    'baseline_added': ('{0} added', None),
+    'baseline_removed': ('{0} removed', None),
+    'baseline_modified': (lambda result: '{0} modified: {1}'.format(
+        result.target, ', '.join(result.found)), None),
+}
+
+
+class _Result(collections.namedtuple('_Result',
+                                     'kind target expected ok found')):
+    '''
+    the outcome of a check, only turned into a message when the details are
+    asked for
+    '''
+
+    __slots__ = ()
+
+    def message(self):
+        message, found = _MESSAGES[self.kind]
+        if callable(message):
+            return message(self)
+        message = message.format(self.target, self.expected)
+        if found is not None and not self.ok:
+            message += found.format(self.found)
+        return message
+
+
+class _Run(object):
+    '''
+    results of a single run_all or check call
+
+    a new one is created for every call and dropped once its report has been
+    returned, so nothing accumulates in a long running minion. passes and
+    failures are counted as they are recorded, the results themselves are
+    only kept with keep=True.
+    '''
+
+    def __init__(self, facts=None, profile=None, keep=True, batch=False):
+        self.passed = []
+        self.failed = []
+        self.pass_count = 0
+        self.fail_count = 0
+        self.keep = keep
+        # runs of run_all, whose checks leave formatting to run_all
+        self.batch = batch
+        self.facts = facts if facts is not None else _Facts()
+        # _Profile of run_all(profile=True), None otherwise
+        self.profile = profile
+
+    def record(self, kind, target, expected, ok, found=None):
+        if ok:
+            self.pass_count += 1
+            if self.keep:
+                self.passed.append(
+                    _Result(kind, target, expected, True, found))
+        else:
+            self.fail_count += 1
+            if self.keep:
+                self.failed.append(
+                    _Result(kind, target, expected, False, found))
+
+    def details(self):
+        return {'Passed': [result.message() for result in self.passed],
+                'Failed': [result.message() for result in self.failed]}
+
+    def totals(self):
+        return {'Pass': self.pass_count, 'Fail': self.fail_count}
+
+    def report(self):
+        '''
+        return the messages of the results, None for a batch run
+        '''
+        if self.batch:
+            return None
+        return self.details()
+
+    def fork(self):
+        '''
+        return a run with its own results that shares this run's facts
+        '''
+        return _Run(self.facts, self.profile, self.keep, self.batch)
+
+    def merge(self, other):
+        '''
+        append the results of a forked run
+        '''
+        self.passed.extend(other.passed)
+        self.failed.extend(other.failed)
+        self.pass_count += other.pass_count
+        self.fail_count += other.fail_count
+
+
+class _CheckProfile(object):
+    '''
+    what running a single check took
+    '''
+
+    __slots__ = ('kind', 'target', 'seconds', 'commands', 'bytes_read')
+
+    def __init__(self, kind, target):
+        self.kind = kind
+        self.target = target
+        self.seconds = 0.0
+        self.commands = 0
+        self.bytes_read = 0
+
+    def report(self):
+        return {'kind': self.kind, 'target': self.target,
+                'seconds': round(self.seconds, 6),
+                'commands': self.commands, 'bytes_read': self.bytes_read}
+
+
+class _Profile(object):
+    '''
+    timings of the checks of a run_all(profile=True) call
+
+    subprocesses and bytes read are counted for the check that caused them.
+    facts are gathered once per run, so the first check that needs them is
+    charged for it.
+    '''
+
+    def __init__(self):
+        self.checks = []
+        self.lock = threading.Lock()
+
+    def measure(self, check, func, run):
+        record = _CheckProfile(check.kind, check.target)
+        outer = getattr(_PROFILING, 'record', None)
+        _PROFILING.record = record
+        started = time.perf_counter()
+        try:
+            func(run, *check.args)
+        finally:
+            record.seconds = time.perf_counter() - started
+            _PROFILING.record = outer
+            with self.lock:
+                self.checks.append(record)
+
+    def report(self, top=10):
+        categories = {}
+        for record in self.checks:
+            category = categories.setdefault(record.kind.partition('_')[0], {
+                'checks': 0, 'seconds': 0.0, 'commands': 0, 'bytes_read': 0})
+            category['checks'] += 1
+            category['seconds'] += record.seconds
+            category['commands'] += record.commands
+            category['bytes_read'] += record.bytes_read
+        for category in categories.values():
+            category['seconds'] = round(category['seconds'], 6)
+        slowest = sorted(self.checks, key=lambda record: record.seconds,
+                         reverse=True)[:top]
+        seconds = sum(record.seconds for record in self.checks)
+        return {'Checks': len(self.checks),
+                'Seconds': round(seconds, 6),
+                'Categories': categories,
+                'Slowest': [record.report() for record in slowest]}
+
+
+def _count(commands=0, bytes_read=0):
+    '''
+    charge commands and bytes_read to the check being profiled, if any
+    '''
+    record = getattr(_PROFILING, 'record', None)
+    if record is not None:
+        record.commands += commands
+        record.bytes_read += bytes_read
+
+
+class _Facts(object):
+    '''
+    facts gathered during a run, shared by every check on a target
+    '''
+
+    def __init__(self):
+        self.files = {}
+        self.users = {}
+        self.groups = {}
+        # path => digest algorithms the run will ask for, see digest()
+        self.wanted = {}
+        # sysctl keys the run will ask for, see sysctl()
+        self.sysctl_keys = set()
+        # persistent _DigestCache, set by run_all when enabled
+        self.digest_cache = None
+        self._cache = {}
+        self._locks = {}
+
+    def _once(self, key, load):
+        '''
+        return the cached value for key, calling load() on first use
+
+        concurrent workers asking for the same key wait for a single load
+        instead of each doing their own. nothing is cached when load raises,
+        as when a command it ran was killed at the check deadline.
+        '''
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        with self._locks.setdefault(key, threading.Lock()):
+            if key not in self._cache:
+                self._cache[key] = load()
+        return self._cache[key]
+
+    def file(self, path):
+        '''
+        return the facts for path, gathering them on first use
+        '''
+        facts = self.files.get(path)
+        if facts is None:
+            facts = self.files[path] = _FileFacts(path, self.users,
+                                                  self.groups)
+        return facts
+
+    def glob(self, pattern):
+        '''
+        return the paths matching pattern, walking the file system once per
+        run and seeding the file facts of every match from the walk
+        '''
+        def load():
+            matches = _glob(pattern, int(_config('glob_depth', 16)))
+            for path, lstat in matches:
+                if path not in self.files:
+                    self.files[path] = _FileFacts(path, self.users,
+                                                  self.groups, lstat)
+            return [path for path, _ in matches]
+        return self._once(('glob', pattern), load)
+
+    def package(self, name):
+        '''
+        return (installed, version) of package name
+
+        served from one listing of all packages per run; hosts without dpkg
+        or rpm fall back to testinfra
+        '''
+        packages = self._once('packages', _packages)
+        if packages is not None:
+            return packages.get(name, (False, None))
+        package = _host().package(name)
+        if package.is_installed:
+            return True, package.version
+        return False, None
+
+    def service(self, name):
+        '''
+        return the state of service name, with running and enabled attributes
+
+        systemd units are served from one bulk listing per run, with a
+        systemctl show for units it doesn't cover. SysV and other init
+        systems fall back to testinfra.
+        '''
+        services = self._once('services', _services)
+        if services is None:
+            return self._once(('service', name),
+                              lambda: _TestinfraService(name))
+        unit = _unit_name(name)
+        if unit in services:
+            return services[unit]
+        return self._once(('service', unit), lambda: _service_show(unit))
+
+    def service_valid(self, name):
+        '''
+        return whether service name is valid, verifying each systemd unit
+        once per run. SysV and other init systems fall back to testinfra.
+        '''
+        if self._once('services', _services) is None:
+            return self.service(name).valid
+        unit = _unit_name(name)
+        return self._once(('verify', unit), lambda: _service_verify(unit))
+
+    def socket_listening(self, spec):
+        '''
+        return whether socket spec is listening
+
+        served from one read of /proc/net per run, falling back to testinfra
+        where there is no /proc
+        '''
+        sockets = self._once('sockets', _sockets)
+        if sockets is None:
+            return _host().socket(spec).is_listening
+        return _is_listening(sockets, spec)
+
+    def processes(self, comm=None, user=None, cmdline=None, match='exact'):
+        '''
+        return the processes matching, see _ProcessTable.filter
+
+        served from one scan of /proc per run, falling back to testinfra
+        (ps) where there is no /proc
+        '''
+        table = self._once('processes', _processes)
+        if table is None:
+            if match == 'regex' or cmdline is not None:
+                table = self._once('ps', lambda: _ProcessTable([
+                    _Process(proc.pid, proc.comm, proc.user, proc.args)
+                    for proc in _host().process.filter()]))
+            else:
+                return _host().process.filter(comm=comm, user=user)
+        return table.filter(comm, user, cmdline, match)
+
+    def user(self, name):
+        '''
+        return the passwd entry of user name, None if there is none
+
+        entries are looked up through NSS, so LDAP and other backends
+        work, and each user at most once per run
+        '''
+        return self._once(('user', name), lambda: _getent(pwd.getpwnam, name))
+
+    def group(self, name):
+        '''
+        return the group entry of group name, None if there is none
+        '''
+        return self._once(('group', name), lambda: _getent(grp.getgrnam, name))
+
+    def user_group(self, name):
+        '''
+        return the name of the primary group of user name
+        '''
+        entry = self.user(name)
+        return entry and _group_name(entry.pw_gid, self.groups)
+
+    def user_gids(self, name):
+        '''
+        return the ids of the groups user name is in, primary group first
+        like id -G, None if there is no such user
+
+        getgrouplist asks NSS for just this user, which also works with
+        backends that don't enumerate their groups. without it (python 2)
+        the memberships of every user are gathered once from getgrall.
+        '''
+        entry = self.user(name)
+        if entry is None:
+            return None
+        if hasattr(os, 'getgrouplist'):
+            gids = self._once(('gids', name),
+                              lambda: os.getgrouplist(name, entry.pw_gid))
+        else:
+            members = self._once('members', _group_members)
+            gids = [entry.pw_gid] + members.get(name, [])
+        seen = set()
+        return [gid for gid in gids if not (gid in seen or seen.add(gid))]
+
+    def user_groups(self, name):
+        '''
+        return the names of the groups user name is in, like id -nG
+        '''
+        gids = self.user_gids(name)
+        if gids is None:
+            return None
+        return [_group_name(gid, self.groups) for gid in gids]
+
+    def mount(self, mountpoint):
+        '''
+        return the _Mount at mountpoint, None if nothing is mounted there
+
+        served from one parse of the mount table per run, falling back to
+        testinfra where there is no /proc
+        '''
+        mounts = self._once('mounts', _mounts)
+        if mounts is not None:
+            return mounts.get(mountpoint)
+        mount = _host().mount_point(mountpoint)
+        if not mount.exists:
+            return None
+        return _Mount(mount.device, mount.filesystem, mount.options,
+                      frozenset(mount.options))
+
+    def sysctl(self, key):
+        '''
+        return the value of sysctl key, None if there is no such key
+
+        the first key asked for reads every key in sysctl_keys with it.
+        without /proc/sys the value comes from testinfra.
+        '''
+        keys = self.sysctl_keys | set([key])
+        values = self._once('sysctls', lambda: _sysctls(keys))
+        if values is None:
+            try:
+                return _host().sysctl(key)
+            except AssertionError:
+                return None
+        if key not in values:
+            values.update(_sysctls([key]))
+        return values[key]
+
+    def interface_exists(self, name):
+        '''
+        return whether interface name exists, from one listing of
+        /sys/class/net per run
+        '''
+        names = self._once('interfaces', _interface_names)
+        if names is None:
+            return _host().interface(name).exists
+        return name in names
+
+    def interface_speed(self, name):
+        '''
+        return the speed of interface name
+        '''
+        if self._once('interfaces', _interface_names) is None:
+            return _host().interface(name).speed
+        return self._once(('speed', name), lambda: _link_speed(name))
+
+    def interface_addresses(self, name):
+        '''
+        return the set of addresses of interface name, from one query of
+        all addresses per run
+        '''
+        addresses = self._once('addresses', _interface_addresses)
+        if addresses is None:
+            return self._once(('addresses', name),
+                              lambda: set(_host().interface(name).addresses))
+        return addresses.get(name, set())
+
+    def want_digest(self, path, algorithm):
+        '''
+        note that the run will check the algorithm digest of path
+        '''
+        self.wanted.setdefault(path, set()).add(algorithm)
+
+    def digest(self, path, algorithm):
+        '''
+        return the algorithm hex digest of path, None if it can't be read
+
+        the first digest asked for a path also computes every other digest
+        wanted for it, all from the same read of the file
+        '''
+        algorithms = self.wanted.get(path, set()) | set([algorithm])
+        digests = self._once(('digest', path),
+                             lambda: self._read_digests(path, algorithms))
+        if digests is not None and algorithm not in digests:
+            digests.update(self._read_digests(path, [algorithm]) or {})
+        return digests and digests.get(algorithm)
+
+    def _read_digests(self, path, algorithms):
+        cache = self.digest_cache
+        if cache is None:
+            return _digests(path, algorithms)
+        try:
+            before = os.stat(path)
+        except OSError:
+            return None
+        digests = cache.get(path, before, algorithms)
+        if digests is None:
+            started = time.time()
+            digests = _digests(path, algorithms)
+            if digests is not None:
+                cache.put(path, before, started, digests)
+        return digests
+
+
+class _DigestCache(object):
+    '''
+    file digests kept on disk between runs
+
+    entries are keyed on the path and only used while the file's (st_dev,
+    st_ino, st_size, st_mtime_ns, st_ctime_ns) are unchanged, so a warm run
+    skips reading unchanged files. ctime can not be set back, a file
+    rewritten in place with its mtime restored is read again. a digest is
+    only stored when the file was not modified shortly before or while it
+    was read. beyond size entries the least recently used ones are dropped,
+    and the file is replaced atomically.
+    '''
+
+    VERSION = 2
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, size):
+        cache = cls(path, size)
+        try:
+            with open(path) as handle:
+                data = json.load(handle)
+            if data.get('version') == cls.VERSION:
+                cache.entries = data['entries']
+        except (EnvironmentError, ValueError, KeyError, AttributeError):
+            # missing or unreadable, start over
+            cache.dirty = True
+        return cache
+
+    @staticmethod
+    def _key(st):
+        return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                st.st_ctime_ns]
+
+    def get(self, path, st, algorithms):
+        '''
+        return the cached digests of path, None unless all of algorithms are
+        cached for a file that still has stat result st
+        '''
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return None
+            if entry['key'] != self._key(st):
+                del self.entries[path]
+                self.dirty = True
+                return None
+            if not set(algorithms) <= set(entry['digests']):
+                return None
+            entry['used'] = time.time()
+            self.dirty = True
+            return dict(entry['digests'])
+
+    def put(self, path, st, started, digests):
+        '''
+        remember digests of path, which had stat result st when reading
+        began at started
+        '''
+        try:
+            after = os.stat(path)
+        except OSError:
+            return
+        key = self._key(st)
+        if self._key(after) != key:
+            return
+        if st.st_mtime_ns >= (started - _RACY_SECONDS) * 1e9:
+            return
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry['key'] != key:
+                entry = self.entries[path] = {'key': key, 'digests': {}}
+            entry['digests'].update(digests)
+            entry['used'] = time.time()
+            self.dirty = True
+
+    def save(self):
+        '''
+        write the cache back if it changed, evicting the least recently used
+        entries beyond size
+        '''
+        if not self.dirty:
+            return
+        with self.lock:
+            if len(self.entries) > self.size:
+                keep = sorted(self.entries,
+                              key=lambda path: self.entries[path]['used'],
+                              reverse=True)[:self.size]
+                self.entries = dict((path, self.entries[path])
+                                    for path in keep)
+            data = {'version': self.VERSION, 'entries': self.entries}
+            self.dirty = False
+        _write_json(self.path, data, 'digest cache')
+
+
+class _ResultCache(object):
+    '''
+    check results kept on disk between incremental runs
+
+    entries are keyed on the check and hold the fingerprint of its inputs
+    (see _fingerprint) next to the _Result fields it recorded. refreshed is
+    when every check last ran.
+    '''
+
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.refreshed = 0
+        self.entries = {}
+
+    @classmethod
+    def load(cls, path):
+        cache = cls(path)
+        try:
+            with open(path) as handle:
+                data = json.load(handle)
+            if data.get('version') == cls.VERSION:
+                cache.refreshed = data['refreshed']
+                cache.entries = data['entries']
+        except (EnvironmentError, ValueError, KeyError, AttributeError):
+            # missing or unreadable, start over
+            pass
+        return cache
+
+    def get(self, key, fingerprint):
+        '''
+        return the stored results of a check, None unless it was stored with
+        the same fingerprint
+        '''
+        entry = self.entries.get(key)
+        if (fingerprint is None or entry is None or
+                entry['fingerprint'] != fingerprint):
+            return None
+        return entry['results']
+
+    def save(self, entries, refreshed):
+        '''
+        replace the stored entries, dropping checks no longer planned
+        '''
+        self.entries = entries
+        self.refreshed = refreshed
+        _write_json(self.path, {'version': self.VERSION,
+                                'refreshed': refreshed,
+                                'entries': entries}, 'result cache')
+
+
+def _write_json(path, data, what):
+    '''
+    atomically replace path with data as json
+    '''
+    directory = os.path.dirname(path)
+    try:
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, temp = tempfile.mkstemp(dir=directory or '.',
+                                        prefix='.infratest.')
+        with os.fdopen(handle, 'w') as out:
+            # default=str covers expected values yaml turned into dates
+            json.dump(data, out, default=str)
+        os.rename(temp, path)
+    except EnvironmentError as exc:
+        LOG.warning('infratest: could not write %s %s: %s', what, path, exc)
+
+
+def _digests(path, algorithms):
+    '''
+    return {algorithm: hex digest} of path for each of algorithms, reading
+    the file once, or None if it can't be read
+    '''
+    hashes = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+    read = 0
+    try:
+        with open(path, 'rb') as handle:
+            # small files get a buffer to match, allocating a whole chunk
+            # dominates hashing many of them
+            size = os.fstat(handle.fileno()).st_size
+            buf = bytearray(min(_CHUNK_SIZE, size + 1))
+            view = memoryview(buf)
+            size = handle.readinto(buf)
+            while size:
+                read += size
+                for _, digest in hashes:
+                    digest.update(view[:size])
+                size = handle.readinto(buf)
+    except EnvironmentError:
+        return None
+    finally:
+        _count(bytes_read=read)
+    return dict((algorithm, digest.hexdigest())
+                for algorithm, digest in hashes)
+
+
+def _getent(lookup, name):
+    '''
+    return lookup(name) from pwd or grp, None if there is no such entry
+    '''
+    try:
+        return lookup(name)
+    except KeyError:
+        return None
+
+
+def _group_members():
+    '''
+    return {user: [gid, ...]} of the supplementary groups of every user
+    '''
+    members = {}
+    for group in grp.getgrall():
+        for user in group.gr_mem:
+            members.setdefault(user, []).append(group.gr_gid)
+    return members
+
+
+def _user_name(uid, cache):
+    '''
+    return the name of uid, or the uid itself when it has no passwd entry
+    '''
+    if uid not in cache:
+        try:
+            cache[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            cache[uid] = uid
+    return cache[uid]
+
+
+def _group_name(gid, cache):
+    '''
+    return the name of gid, or the gid itself when it has no group entry
+    '''
+    if gid not in cache:
+        try:
+            cache[gid] = grp.getgrgid(gid).gr_name
+        except KeyError:
+            cache[gid] = gid
+    return cache[gid]
+
+
+class _FileFacts(object):
+    '''
+    metadata of a single path, as the file_* checks see it
+
+    gathered in process with one lstat, plus a stat when the path is a
+    symlink. like testinfra, ownership, mode, size and mtime describe the path
+    itself while exists and the type tests follow symlinks. every attribute
+    is None when the path does not exist.
+
+    lstat can be given when it is already known, from a directory walk.
+    '''
 
-INFRATEST = {}
-INFRATEST['Passed'] = []
-INFRATEST['Failed'] = []
+    def __init__(self, path, users, groups, lstat=None):
+        self.path = path
+        self._users = users
+        self._groups = groups
+        if lstat is None:
+            try:
+                lstat = os.lstat(path)
+            except OSError:
+                pass
+        self.lstat = lstat
+        if self.lstat is not None and stat.S_ISLNK(self.lstat.st_mode):
+            try:
+                self.stat = os.stat(path)
+            except OSError:
+                self.stat = None
+        else:
+            self.stat = self.lstat
+
+    def _is(self, test):
+        return self.stat is not None and test(self.stat.st_mode)
+
+    @property
+    def exists(self):
+        return self.stat is not None
+
+    @property
+    def is_file(self):
+        return self._is(stat.S_ISREG)
+
+    @property
+    def is_directory(self):
+        return self._is(stat.S_ISDIR)
+
+    @property
+    def is_pipe(self):
+        return self._is(stat.S_ISFIFO)
+
+    @property
+    def is_socket(self):
+        return self._is(stat.S_ISSOCK)
+
+    @property
+    def is_symlink(self):
+        return self.lstat is not None and stat.S_ISLNK(self.lstat.st_mode)
+
+    @property
+    def linked_to(self):
+        if self.lstat is None:
+            return None
+        return os.path.realpath(self.path)
+
+    @property
+    def uid(self):
+        return self.lstat and self.lstat.st_uid
+
+    @property
+    def gid(self):
+        return self.lstat and self.lstat.st_gid
+
+    @property
+    def user(self):
+        return self.lstat and _user_name(self.lstat.st_uid, self._users)
+
+    @property
+    def group(self):
+        return self.lstat and _group_name(self.lstat.st_gid, self._groups)
+
+    @property
+    def mode(self):
+        return self.lstat and stat.S_IMODE(self.lstat.st_mode)
+
+    @property
+    def size(self):
+        return self.lstat and self.lstat.st_size
+
+    @property
+    def mtime(self):
+        return self.lstat and datetime.datetime.fromtimestamp(
+            self.lstat.st_mtime)
+
+
+# posix character classes usable in grep bracket expressions. grep matches
+# single lines, so none of them include a newline
+_POSIX_CLASSES = {
+    '[:alnum:]': 'a-zA-Z0-9',
+    '[:alpha:]': 'a-zA-Z',
+    '[:blank:]': ' \\t',
+    '[:cntrl:]': '\\x00-\\x09\\x0b-\\x1f\\x7f',
+    '[:digit:]': '0-9',
+    '[:graph:]': '\\x21-\\x7e',
+    '[:lower:]': 'a-z',
+    '[:print:]': '\\x20-\\x7e',
+    '[:punct:]': '!-/:-@\\[-`{-~',
+    '[:space:]': ' \\t\\r\\f\\v',
+    '[:upper:]': 'A-Z',
+    '[:xdigit:]': '0-9A-Fa-f',
+}
+
+
+def _bre_bracket(pattern, start):
+    '''
+    translate the bracket expression starting at pattern[start]
+
+    returns the python character class and the index following it, or None
+    and start when the bracket is never closed
+    '''
+    out = ['[']
+    i = start + 1
+    if pattern.startswith('^', i):
+        # patterns are searched over many lines at once, a negated class
+        # must not match the newline between them
+        out.append('^\\n')
+        i += 1
+    if pattern.startswith(']', i):
+        out.append('\\]')
+        i += 1
+    while i < len(pattern):
+        char = pattern[i]
+        if char == ']':
+            out.append(']')
+            return ''.join(out), i + 1
+        end = pattern.find(':]', i) + 2
+        if pattern.startswith('[:', i) and pattern[i:end] in _POSIX_CLASSES:
+            out.append(_POSIX_CLASSES[pattern[i:end]])
+            i = end
+            continue
+        if char in '\\[&~|':
+            out.append('\\' + char)
+        else:
+            out.append(char)
+        i += 1
+    return None, start
+
+
+# python escapes that would match a newline, limited to a single line
+_LINE_ESCAPES = {
+    's': '[^\\S\\n]',
+    'D': '[^\\d\\n]',
+    'W': '[^\\w\\n]',
+}
+
+
+def _bre(pattern):
+    '''
+    translate a grep basic regular expression into a python one
+
+    testinfra's File.contains ran grep, so pillar patterns are written as
+    basic regular expressions: ( ) { } | + ? are literal unless escaped,
+    \\< and \\> are word boundaries and a leading * is literal.
+    '''
+    out = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern):
+            char = pattern[i + 1]
+            if char in '(){}|+?':
+                out.append(char)
+            elif char in '<>':
+                out.append('\\b')
+            elif char in _LINE_ESCAPES:
+                out.append(_LINE_ESCAPES[char])
+            else:
+                out.append('\\' + char)
+            i += 2
+            continue
+        if char == '[':
+            bracket, i = _bre_bracket(pattern, i)
+            if bracket is not None:
+                out.append(bracket)
+                continue
+            out.append('\\[')
+        elif char in '(){}|+?':
+            out.append('\\' + char)
+        elif char == '*' and (not out or out[-1] in ('^', '(', '|')):
+            out.append('\\*')
+        else:
+            out.append(char)
+        i += 1
+    return ''.join(out)
+
+
+_GLOB_MAGIC = re.compile(r'[*?[]')
+
+
+def _glob(pattern, depth=16):
+    '''
+    return sorted (path, lstat) pairs of the entries matching pattern
+
+    each component may hold shell wildcards (*, ? and [...]), which unlike
+    the shell's also match names starting with a dot, and a ** component
+    matches any number of directories, or everything below a directory at
+    the end of pattern. directories are read with os.scandir, the lstat of
+    every match comes from its directory entry, and ** descends no more
+    than depth levels without following symlinks.
+    '''
+    parts = pattern.split('/')
+    magic = 0
+    while magic < len(parts) and not _GLOB_MAGIC.search(parts[magic]):
+        magic += 1
+    if magic == len(parts):
+        try:
+            return [(pattern, os.lstat(pattern))]
+        except OSError:
+            return []
+    base = '/'.join(parts[:magic]) or ('/' if pattern.startswith('/') else '.')
+    matches = {}
+    if _glob_walk(base, '/'.join(parts[:magic]), parts[magic:], depth,
+                  matches):
+        LOG.warning('infratest: %s only searched %d directories deep, see '
+                    'infratest:glob_depth', pattern, depth)
+    return sorted(matches.items())
+
+
+def _glob_walk(directory, prefix, parts, depth, matches):
+    '''
+    add the entries below directory matching the components parts to
+    matches, as path => lstat, and return whether directories beyond depth
+    were left out. prefix is how directory is spelled in paths
+    '''
+    part, rest = parts[0], parts[1:]
+    truncated = False
+    if part == '**' and rest:
+        # ** standing for no directory at all
+        truncated = _glob_walk(directory, prefix, rest, depth, matches)
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return truncated
+    if part != '**':
+        regex = _glob_regex(part)
+    for entry in entries:
+        if prefix or directory == '/':
+            path = prefix + '/' + entry.name
+        else:
+            path = entry.name
+        if part == '**':
+            if not rest:
+                matches[path] = entry.stat(follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                if depth > 0:
+                    truncated |= _glob_walk(entry.path, path, parts,
+                                            depth - 1, matches)
+                else:
+                    truncated = True
+        elif regex.match(entry.name):
+            if not rest:
+                matches[path] = entry.stat(follow_symlinks=False)
+            elif entry.is_dir():
+                truncated |= _glob_walk(entry.path, path, rest, depth, matches)
+    return truncated
+
+
+_GLOB_REGEXES = {}
+
+
+def _glob_regex(part):
+    regex = _GLOB_REGEXES.get(part)
+    if regex is None:
+        if len(_GLOB_REGEXES) > 256:
+            _GLOB_REGEXES.clear()
+        regex = _GLOB_REGEXES[part] = re.compile(fnmatch.translate(part))
+    return regex
+
+
+def _contains(path, patterns):
+    '''
+    return the set of patterns that match a line of path
+
+    the file is read once, in line aligned chunks that are searched for every
+    pattern not matched yet. memory stays bounded on multi-GB files and
+    reading stops as soon as all patterns have matched. lines longer than a
+    chunk are searched in overlapping windows.
+    '''
+    pending = {}
+    for pattern in patterns:
+        try:
+            pending[pattern] = re.compile(_bre(pattern).encode('utf-8'), re.M)
+        except re.error:
+            # grep exits with an error, which testinfra reported as False
+            LOG.warning('infratest: invalid pattern %r', pattern)
+    found = set()
+
+    def search(buf, start, partial):
+        for pattern, regex in list(pending.items()):
+            match = regex.search(buf, start)
+            # a window ends mid-line, where $ matches and a longer match
+            # may be cut short. the next window overlaps it.
+            if match is not None and not (partial and match.end() == len(buf)):
+                found.add(pattern)
+                del pending[pattern]
+
+    try:
+        with open(path, 'rb') as handle:
+            rest = b''
+            # 1 while rest continues a line whose start was searched, so ^
+            # doesn't match at the start of the window
+            start = 0
+            while pending:
+                chunk = handle.read(_CHUNK_SIZE)
+                if chunk:
+                    cut = chunk.rfind(b'\n') + 1
+                    if not cut:
+                        rest += chunk
+                        if len(rest) >= _CHUNK_SIZE + _LINE_OVERLAP:
+                            search(rest, start, True)
+                            rest = rest[-_LINE_OVERLAP:]
+                            start = 1
+                        continue
+                    buf, rest = rest + chunk[:cut], chunk[cut:]
+                else:
+                    buf, rest = rest, b''
+                search(buf, start, False)
+                start = 0
+                if not chunk:
+                    break
+            _count(bytes_read=handle.tell())
+    except EnvironmentError:
+        pass
+    return found
 
 
 def __virtual__():
@@ -50,6 +1190,555 @@ def __virtual__():
     return __virtualname__
 
 
+class _CommandTimeout(Exception):
+    '''
+    raised by _command when it killed a command at the check deadline, so
+    that the check is reported as timed out and no fact is cached from it
+    '''
+
+
+def _command(*args, stderr=False):
+    '''
+    return the output of a command, None if it can't be run or fails
+
+    with stderr=True, what the command writes to stderr is part of the output.
+    raises _CommandTimeout when the command runs past the check deadline.
+    '''
+    _count(commands=1)
+    try:
+        proc = subprocess.Popen(
+            args, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if stderr else subprocess.PIPE)
+    except OSError:
+        return None
+    at = getattr(_DEADLINE, 'at', None)
+    try:
+        out, _ = proc.communicate(
+            timeout=None if at is None else max(at - time.time(), 0))
+    except subprocess.TimeoutExpired:
+        LOG.warning('infratest: killing %s, past the check deadline', args[0])
+        proc.kill()
+        proc.communicate()
+        raise _CommandTimeout(args[0])
+    _count(bytes_read=len(out))
+    if proc.returncode != 0:
+        return None
+    return out.decode('utf-8', 'replace')
+
+
+def _read(path):
+    '''
+    return the text of a /proc or /sys file, counting the bytes read
+    '''
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    _count(bytes_read=len(data))
+    return data.decode('utf-8', 'replace')
+
+
+def _packages():
+    '''
+    return {name: (installed, version)} for every known package, from a
+    single dpkg-query or rpm listing, or None if neither is available
+
+    debian packages are also listed as name:arch, the bare name is installed
+    when any architecture is. like testinfra, packages that are not
+    installed have no version.
+    '''
+    out = _command('dpkg-query', '-W', '-f',
+                   '${Package}\t${Architecture}\t${Status}\t${Version}\n')
+    if out is not None:
+        packages = {}
+        for line in out.splitlines():
+            try:
+                name, arch, status, version = line.split('\t')
+            except ValueError:
+                continue
+            # same test as testinfra's DebianPackage.is_installed
+            status = status.split()
+            installed = (status[:1] in (['install'], ['hold']) and
+                         status[1:3] == ['ok', 'installed'])
+            entry = (installed, version if installed else None)
+            packages[name + ':' + arch] = entry
+            if installed or not packages.get(name, (False, None))[0]:
+                packages[name] = entry
+        return packages
+    out = _command('rpm', '-qa', '--queryformat', '%{NAME}\t%{VERSION}\n')
+    if out is not None:
+        packages = {}
+        for line in out.splitlines():
+            name, _, version = line.partition('\t')
+            packages[name] = (True, version)
+        return packages
+    return None
+
+
+# unit file states for which systemctl is-enabled succeeds
+_ENABLED_STATES = ('enabled', 'enabled-runtime', 'static', 'indirect',
+                   'generated', 'transient', 'alias')
+
+_UNIT_SUFFIXES = ('.service', '.socket', '.device', '.mount', '.automount',
+                  '.swap', '.target', '.path', '.timer', '.slice', '.scope')
+
+_ServiceState = collections.namedtuple('_ServiceState', 'running enabled')
+
+
+def _unit_name(name):
+    '''
+    return the systemd unit of a service name, adding .service if needed
+    '''
+    if name.endswith(_UNIT_SUFFIXES):
+        return name
+    return name + '.service'
+
+
+def _service_state(active, unit_file):
+    return _ServiceState(active == 'active', unit_file in _ENABLED_STATES)
+
+
+def _services():
+    '''
+    return {unit: _ServiceState} for the loaded service units that have a
+    unit file, from one systemctl list-units and one list-unit-files, or
+    None when systemd is not running
+    '''
+    units = _command('systemctl', 'list-units', '--all', '--type=service',
+                     '--no-legend', '--no-pager', '--plain')
+    unit_files = _command('systemctl', 'list-unit-files', '--type=service',
+                          '--no-legend', '--no-pager')
+    if units is None or unit_files is None:
+        return None
+    unit_file_states = {}
+    for line in unit_files.splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            unit_file_states[fields[0]] = fields[1]
+    services = {}
+    for line in units.splitlines():
+        fields = line.split()
+        if fields and fields[0] in (u'\u25cf', '*'):
+            # failed and not-found units are marked, even with --plain
+            fields = fields[1:]
+        if len(fields) >= 3 and fields[0] in unit_file_states:
+            services[fields[0]] = _service_state(
+                fields[2], unit_file_states[fields[0]])
+    return services
+
+
+def _service_show(unit):
+    '''
+    return the _ServiceState of a single unit, for aliases, template
+    instances and units systemd has not loaded
+    '''
+    out = _command('systemctl', 'show', unit, '--no-pager',
+                   '--property=ActiveState,UnitFileState') or ''
+    props = dict(line.partition('=')[::2] for line in out.splitlines())
+    return _service_state(props.get('ActiveState'),
+                          props.get('UnitFileState'))
+
+
+def _service_verify(unit):
+    '''
+    return whether systemd-analyze verify finds nothing to report on unit,
+    the same test as testinfra's is_valid
+    '''
+    return _command('systemd-analyze', 'verify', unit, stderr=True) == ''
+
+
+class _TestinfraService(object):
+    '''
+    service state from testinfra, for hosts without systemd
+    '''
+
+    def __init__(self, name):
+        self._service = _host().service(name)
+
+    @property
+    def running(self):
+        return self._service.is_running
+
+    @property
+    def enabled(self):
+        return self._service.is_enabled
+
+    @property
+    def valid(self):
+        try:
+            return self._service.is_valid
+        # is_valid raises an assertion error on failure
+        except (AssertionError, NotImplementedError):
+            return False
+
+
+# socket states /proc/net reports for listening tcp and bound udp sockets
+_LISTEN_STATES = (('tcp', '0A'), ('udp', '07'))
+
+# flag /proc/net/unix sets on listening unix sockets
+_SO_ACCEPTCON = 0x10000
+
+
+def _proc_net_address(address):
+    '''
+    decode a hex address:port from /proc/net/tcp and the like
+    '''
+    host, port = address.split(':')
+    packed = binascii.unhexlify(host)
+    if sys.byteorder == 'little':
+        # the address is printed as 32 bit words in host byte order
+        packed = b''.join(packed[i:i + 4][::-1]
+                          for i in range(0, len(packed), 4))
+    family = socket.AF_INET if len(packed) == 4 else socket.AF_INET6
+    return socket.inet_ntop(family, packed), int(port, 16)
+
+
+def _sockets():
+    '''
+    return the set of listening sockets as (protocol, host, port) and
+    ('unix', path) tuples, read once from /proc/net, or None without it
+    '''
+    sockets = set()
+    try:
+        for protocol, state in _LISTEN_STATES:
+            for version in ('', '6'):
+                path = os.path.join(_PROC, 'net', protocol + version)
+                if version and not os.path.exists(path):
+                    # ipv6 disabled
+                    continue
+                for line in _read(path).splitlines()[1:]:
+                    fields = line.split()
+                    if fields[3] == state:
+                        host, port = _proc_net_address(fields[1])
+                        sockets.add((protocol, host, port))
+        unix = _read(os.path.join(_PROC, 'net', 'unix'))
+        for line in unix.splitlines()[1:]:
+            fields = line.split()
+            if len(fields) < 8:
+                # unbound
+                continue
+            # listening stream sockets and bound datagram sockets, as
+            # listed by ss -l and netstat -l
+            listening = int(fields[3], 16) & _SO_ACCEPTCON
+            datagram = fields[4] == '0002' and fields[5] == '01'
+            if listening or datagram:
+                sockets.add(('unix', fields[7]))
+    except EnvironmentError:
+        return None
+    return sockets
+
+
+def _is_listening(sockets, spec):
+    '''
+    look spec (tcp://22, udp://127.0.0.1:53, unix:///run/foo.sock, ...) up
+    in sockets, the way testinfra's Socket.is_listening does
+    '''
+    protocol, _, address = spec.partition('://')
+    if protocol == 'unix':
+        return ('unix', address) in sockets
+    host, _, port = address.rpartition(':')
+    port = int(port)
+    if (protocol, '::', port) in sockets:
+        return True
+    if not host:
+        # tcp://22 is only listening when it is on all ipv6 addresses too
+        return False
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    host = socket.inet_ntop(family, socket.inet_pton(family, host))
+    if family == socket.AF_INET and (protocol, '0.0.0.0', port) in sockets:
+        return True
+    return (protocol, host, port) in sockets
+
+
+_Process = collections.namedtuple('_Process', 'pid comm user cmdline')
+
+
+class _ProcessTable(object):
+    '''
+    every process on the host, indexed by comm and user
+    '''
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.by_comm = {}
+        self.by_user = {}
+        for process in processes:
+            self.by_comm.setdefault(process.comm, []).append(process)
+            self.by_user.setdefault(process.user, []).append(process)
+
+    def filter(self, comm=None, user=None, cmdline=None, match='exact'):
+        '''
+        return the processes with comm, owned by user and whose command line
+        matches the cmdline regular expression
+
+        with match='regex' comm is a regular expression searched in each
+        process name instead of the exact name
+        '''
+        if comm is not None and match == 'regex':
+            pattern = re.compile(comm)
+            found = [process for process in self.processes
+                     if pattern.search(process.comm)]
+        elif comm is not None:
+            found = self.by_comm.get(comm, [])
+        elif user is not None:
+            found = self.by_user.get(user, [])
+        else:
+            found = self.processes
+        if user is not None:
+            found = [process for process in found if process.user == user]
+        if cmdline is not None:
+            pattern = re.compile(cmdline)
+            found = [process for process in found
+                     if pattern.search(process.cmdline)]
+        return found
+
+
+def _processes():
+    '''
+    return a _ProcessTable from one scan of /proc, or None without it
+
+    like ps, the user is the effective one and the command line has its
+    arguments joined by spaces
+    '''
+    try:
+        pids = [name for name in os.listdir(_PROC) if name.isdigit()]
+    except EnvironmentError:
+        return None
+    users = {}
+    processes = []
+    for pid in pids:
+        comm = uid = None
+        try:
+            for line in _read(os.path.join(_PROC, pid, 'status')).splitlines():
+                if line.startswith('Name:'):
+                    comm = line[5:].strip()
+                elif line.startswith('Uid:'):
+                    uid = int(line.split()[2])
+                    break
+            cmdline = _read(os.path.join(_PROC, pid, 'cmdline'))
+        except EnvironmentError:
+            # exited while /proc was being scanned
+            continue
+        cmdline = cmdline.rstrip('\0').replace('\0', ' ')
+        processes.append(_Process(int(pid), comm, _user_name(uid, users),
+                                  cmdline))
+    return _ProcessTable(processes)
+
+
+_Mount = collections.namedtuple('_Mount',
+                                'device filesystem options option_set')
+
+
+def _unescape_mount(field):
+    '''
+    decode the octal escapes (\\040 for a space, ...) of a mountinfo field
+    '''
+    return re.sub(r'\\([0-7]{3})',
+                  lambda match: chr(int(match.group(1), 8)), field)
+
+
+def _mounts():
+    '''
+    return {mountpoint: _Mount} from one parse of /proc/self/mountinfo, or
+    None without it
+
+    options are listed the way /proc/mounts (and so testinfra) shows them:
+    the mount's own options followed by the filesystem specific ones. when
+    mounts are stacked on a mountpoint the topmost one wins.
+    '''
+    mounts = {}
+    try:
+        mountinfo = _read(os.path.join(_PROC, 'self', 'mountinfo'))
+    except EnvironmentError:
+        return None
+    for line in mountinfo.splitlines():
+        fields = line.split()
+        separator = fields.index('-', 6)
+        options = fields[5].split(',')
+        options.extend(option for option in fields[separator + 3].split(',')
+                       if option not in ('ro', 'rw') and
+                       option not in options)
+        mounts[_unescape_mount(fields[4])] = _Mount(
+            _unescape_mount(fields[separator + 2]),
+            fields[separator + 1], options, frozenset(options))
+    return mounts
+
+
+def _sysctl_path(key):
+    '''
+    return the /proc/sys file of a sysctl key
+
+    like sysctl(8), keys may use / as the separator, and when a key mixes
+    both (net.ipv4.conf.eth0/100.rp_filter) dots and slashes swap roles
+    '''
+    if '/' in key and '.' in key.partition('/')[0]:
+        key = key.translate({ord('.'): u'/', ord('/'): u'.'})
+    elif '/' not in key:
+        key = key.replace('.', '/')
+    return os.path.join(_PROC, 'sys', key.strip('/'))
+
+
+def _sysctls(keys):
+    '''
+    return {key: value} for each sysctl key, read from /proc/sys in one go
+
+    values are coerced like testinfra's Sysctl does: ints when they parse
+    as one, strings otherwise. keys that can't be read are None, and None
+    is returned instead of the dict without /proc/sys.
+    '''
+    if not os.path.isdir(os.path.join(_PROC, 'sys')):
+        return None
+    values = {}
+    for key in keys:
+        try:
+            value = _read(_sysctl_path(key)).rstrip('\n')
+        except EnvironmentError:
+            values[key] = None
+            continue
+        try:
+            values[key] = int(value)
+        except ValueError:
+            values[key] = value
+    return values
+
+
+def _interface_names():
+    '''
+    return the set of network interface names in /sys/class/net, or None
+    without it
+    '''
+    try:
+        return set(os.listdir(os.path.join(_SYS, 'class', 'net')))
+    except EnvironmentError:
+        return None
+
+
+def _link_speed(name):
+    '''
+    return the speed of interface name in Mb/s, None when it has none
+    '''
+    try:
+        return int(_read(os.path.join(_SYS, 'class', 'net', name, 'speed')))
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def _interface_addresses():
+    '''
+    return {interface: set of addresses} for every interface, from a single
+    ip -j addr query, or ip -o addr on iproute2 without json output. None
+    when ip is not available.
+    '''
+    out = _command('ip', '-j', 'addr', 'show')
+    try:
+        return dict((link['ifname'],
+                     set(address['local']
+                         for address in link.get('addr_info', [])
+                         if 'local' in address))
+                    for link in json.loads(out))
+    except (TypeError, ValueError, KeyError):
+        pass
+    out = _command('ip', '-o', 'addr', 'show')
+    if out is None:
+        return None
+    addresses = {}
+    for line in out.splitlines():
+        # 2: eth0    inet 10.0.2.15/24 brd 10.0.2.255 scope global eth0 ...
+        fields = line.split()
+        if len(fields) >= 4 and fields[2] in ('inet', 'inet6'):
+            name = fields[1].partition('@')[0]
+            addresses.setdefault(name, set()).add(fields[3].partition('/')[0])
+    return addresses
+
+
+def _config(name, default):
+    '''
+    return infratest:<name> from the minion config, grains or pillar
+    '''
+    try:
+        return __salt__['config.get']('infratest:' + name, default)
+    except (NameError, KeyError):
+        return default
+
+
+def _digest_cache():
+    '''
+    return the persistent digest cache, None when disabled
+
+    configured with infratest:digest_cache, a path that defaults to
+    infratest/digests.json in the minion cachedir or False to disable it,
+    and infratest:digest_cache_size, the number of files kept
+    '''
+    try:
+        default = os.path.join(__opts__['cachedir'], 'infratest',
+                               'digests.json')
+    except (NameError, KeyError):
+        default = None
+    path = _config('digest_cache', default)
+    if not path:
+        return None
+    return _DigestCache.load(path, int(_config('digest_cache_size', 10000)))
+
+
+def _result_cache():
+    '''
+    return the result cache of incremental runs
+
+    configured with infratest:result_cache, a path that defaults to
+    infratest/results.json in the minion cachedir
+    '''
+    try:
+        default = os.path.join(__opts__['cachedir'], 'infratest',
+                               'results.json')
+    except (NameError, KeyError):
+        default = None
+    path = _config('result_cache', default)
+    if not path:
+        return None
+    return _ResultCache.load(path)
+
+
+def _host():
+    '''
+    return the local testinfra host, connecting on first use
+    '''
+    global _HOST
+    with _HOST_LOCK:
+        if _HOST is None:
+            import testinfra
+            host = testinfra.get_host('local://')
+            # testinfra caches hosts, it may be wrapped from an earlier load
+            if not getattr(host.backend.run, 'infratest_counted', False):
+                host.backend.run = _counted(host.backend.run)
+            _HOST = host
+    return _HOST
+
+
+def _counted(run):
+    '''
+    wrap the run method of a testinfra backend, so the commands testinfra
+    starts are counted like the ones of _command
+    '''
+    def counted(*args, **kwargs):
+        _count(commands=1)
+        return run(*args, **kwargs)
+    counted.infratest_counted = True
+    return counted
+
+
+def _report(check, *args):
+    '''
+    run check on a run of its own and return its report, for the checks
+    called directly from the CLI
+    '''
+    run = _Run()
+    check(run, *args)
+    return run.report()
+
+
+def _file_exists(run, thing, expected):
+    found = run.facts.file(thing).exists
+    run.record('file_exists', thing, expected, found == expected)
+
+
 def file_exists(thing, expected):
     '''
     test if file exists
@@ -58,12 +1747,11 @@ def file_exists(thing, expected):
 
         salt '*' infratest.file_exists /etc/passwd true
     '''
-    detail = '{0} exists: {1}'.format(thing, expected)
-    if File(thing).exists == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_exists, thing, expected)
+
+
+def _file_isfile(run, thing, expected):
+    run.record('file_isfile', thing, expected, run.facts.file(thing).is_file)
 
 
 def file_isfile(thing, expected):
@@ -74,12 +1762,12 @@ def file_isfile(thing, expected):
 
         salt '*' infratest.file_isfile /etc/passwd true
     '''
-    detail = '{0} is: {1}'.format(thing, expected)
-    if File(thing).is_file:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_isfile, thing, expected)
+
+
+def _file_isdir(run, thing, expected):
+    run.record('file_isdir', thing, expected,
+               run.facts.file(thing).is_directory)
 
 
 def file_isdir(thing, expected):
@@ -90,12 +1778,11 @@ def file_isdir(thing, expected):
 
         salt '*' infratest.file_isdirectory /etc/init.d true
     '''
-    detail = '{0} is: {1}'.format(thing, expected)
-    if File(thing).is_directory:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_isdir, thing, expected)
+
+
+def _file_ispipe(run, thing, expected):
+    run.record('file_ispipe', thing, expected, run.facts.file(thing).is_pipe)
 
 
 def file_ispipe(thing, expected):
@@ -106,12 +1793,12 @@ def file_ispipe(thing, expected):
 
         salt '*' infratest.file_ispipe /root/fifo1 true
     '''
-    detail = '{0} is: {1}'.format(thing, expected)
-    if File(thing).is_pipe:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_ispipe, thing, expected)
+
+
+def _file_issocket(run, thing, expected):
+    run.record('file_issocket', thing, expected,
+               run.facts.file(thing).is_socket)
 
 
 def file_issocket(thing, expected):
@@ -122,12 +1809,12 @@ def file_issocket(thing, expected):
 
         salt '*' infratest.file_issocket /var/run/mysql.sock true
     '''
-    detail = '{0} is: {1}'.format(thing, expected)
-    if File(thing).is_socket:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_issocket, thing, expected)
+
+
+def _file_issymlink(run, thing, expected):
+    run.record('file_issymlink', thing, expected,
+               run.facts.file(thing).is_symlink)
 
 
 def file_issymlink(thing, expected):
@@ -138,12 +1825,21 @@ def file_issymlink(thing, expected):
 
         salt '*' infratest.file_issymlink /var/run true
     '''
-    detail = '{0} is: {1}'.format(thing, expected)
-    if File(thing).is_symlink:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_issymlink, thing, expected)
+
+
+def _file_glob(run, pattern):
+    # walks pattern ahead of its checks, see _expand
+    run.facts.glob(pattern)
+
+
+def _file_badtype(run, thing, expected):
+    run.record('file_badtype', thing, expected, False)
+
+
+def _file_linkedto(run, thing, expected):
+    found = run.facts.file(thing).linked_to
+    run.record('file_linkedto', thing, expected, found == expected, found)
 
 
 def file_linkedto(thing, expected):
@@ -154,13 +1850,12 @@ def file_linkedto(thing, expected):
 
         salt '*' infratest.file_linkedto /var/run /run
     '''
-    detail = '{0} is linked to: {1}'.format(thing, expected)
-    if File(thing).linked_to == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(File(thing).linked_to)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_linkedto, thing, expected)
+
+
+def _file_user(run, thing, expected):
+    found = run.facts.file(thing).user
+    run.record('file_user', thing, expected, found == expected, found)
 
 
 def file_user(thing, expected):
@@ -171,13 +1866,12 @@ def file_user(thing, expected):
 
         salt '*' infratest.file_user /etc/passwd root
     '''
-    detail = '{0} is owned by user: {1}'.format(thing, expected)
-    if File(thing).user == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(File(thing).user)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_user, thing, expected)
+
+
+def _file_group(run, thing, expected):
+    found = run.facts.file(thing).group
+    run.record('file_group', thing, expected, found == expected, found)
 
 
 def file_group(thing, expected):
@@ -188,13 +1882,12 @@ def file_group(thing, expected):
 
         salt '*' infratest.file_group /etc/passwd wheel
     '''
-    detail = '{0} is owned by group: {1}'.format(thing, expected)
-    if File(thing).group == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found {}'.format(File(thing).group)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_group, thing, expected)
+
+
+def _file_uid(run, thing, expected):
+    found = run.facts.file(thing).uid
+    run.record('file_uid', thing, expected, found == expected, found)
 
 
 def file_uid(thing, expected):
@@ -205,13 +1898,12 @@ def file_uid(thing, expected):
 
         salt '*' infratest.file_uid /etc/passwd 0
     '''
-    detail = '{0} is owned by uid: {1}'.format(thing, expected)
-    if File(thing).uid == vals['uid']:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(File(thing).uid)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_uid, thing, expected)
+
+
+def _file_gid(run, thing, expected):
+    found = run.facts.file(thing).gid
+    run.record('file_gid', thing, expected, found == expected, found)
 
 
 def file_gid(thing, expected):
@@ -222,22 +1914,12 @@ def file_gid(thing, expected):
 
         salt '*' infratest.file_gid /etc/passwd 0
     '''
-    detail = '{0} is owned by gid: {1}'.format(thing, expected)
-    if File(thing).gid == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(File(thing).gid)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_gid, thing, expected)
 
 
-def file_mode(thing, expected):
+def _mode_string(expected):
     '''
-    test file mode
-
-    CLI Example::
-
-        salt '*' infratest.file_mode /etc/passwd 0644
+    return a pillar mode as a 4 digit octal string, i.e. 644 => '0644'
     '''
     if type(expected) == int:
         # convert int to str if required
@@ -245,29 +1927,55 @@ def file_mode(thing, expected):
     if len(expected) == 3:
         # add 0 pad to mode, i.e. 644 => 0644
         expected = '0' + expected
-    detail = '{0} has mode: {1}'.format(thing, expected)
-    if oct(File(thing).mode) == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(oct(File(thing).mode))
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return expected
+
+
+def _file_mode(run, thing, expected):
+    expected = _mode_string(expected)
+    found = run.facts.file(thing).mode
+    if found is not None:
+        found = '{0:04o}'.format(found)
+    run.record('file_mode', thing, expected, found == expected, found)
+
+
+def file_mode(thing, expected):
+    '''
+    test file mode
+
+    CLI Example::
+
+        salt '*' infratest.file_mode /etc/passwd 0644
+    '''
+    return _report(_file_mode, thing, expected)
+
+
+def _file_contains(run, thing, expected):
+    if not isinstance(expected, (list, tuple)):
+        expected = [expected]
+    patterns = [str(pattern) for pattern in expected]
+    found = _contains(thing, patterns)
+    for pattern in patterns:
+        run.record('file_contains', thing, pattern, pattern in found)
 
 
 def file_contains(thing, expected):
     '''
-    test if file contains a pattern
+    test if file contains a pattern, or each pattern of a list
+
+    patterns are grep basic regular expressions. the file is read once no
+    matter how many patterns are given.
 
     CLI Example::
 
         salt '*' infratest.file_contains /etc/passwd root
+        salt '*' infratest.file_contains /etc/hosts '["^127.0.0.1", "local$"]'
     '''
-    detail = '{0} contains: {1}'.format(thing, expected)
-    if File(thing).contains(expected):
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_contains, thing, expected)
+
+
+def _file_md5sum(run, thing, expected):
+    found = run.facts.digest(thing, 'md5')
+    run.record('file_md5sum', thing, expected, found == expected, found)
 
 
 def file_md5sum(thing, expected):
@@ -278,13 +1986,12 @@ def file_md5sum(thing, expected):
 
         salt '*' infratest.file_md5sum /etc/passwd 2131233424234aabbccee...
     '''
-    detail = '{0} has md5sum: {1}'.format(thing, expected)
-    if File(thing).md5sum == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(File(thing).md5sm)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_md5sum, thing, expected)
+
+
+def _file_sha256sum(run, thing, expected):
+    found = run.facts.digest(thing, 'sha256')
+    run.record('file_sha256sum', thing, expected, found == expected, found)
 
 
 def file_sha256sum(thing, expected):
@@ -295,13 +2002,13 @@ def file_sha256sum(thing, expected):
 
         salt '*' infratest.file_sha256sum /etc/passwd 1ab1ab1ab3bbab31ba3b1a...
     '''
-    detail = '{0} has sha256sum: {1}'.format(thing, expected)
-    if File(thing).sha256sum == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(File(thing).sha256sum)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_sha256sum, thing, expected)
+
+
+def _file_mtime(run, thing, expected):
+    mtime = run.facts.file(thing).mtime
+    found = mtime and mtime.strftime('%Y-%m-%d %H:%M:%S')
+    run.record('file_mtime', thing, expected, found == expected)
 
 
 def file_mtime(thing, expected):
@@ -318,13 +2025,12 @@ def file_mtime(thing, expected):
     i.e. mtime: '2015-09-01 23:11:03'
     see https://docs.saltstack.com/en/latest/topics/troubleshooting/yaml_idiosyncrasies.html#automatic-datetime-conversion
     '''
+    return _report(_file_mtime, thing, expected)
 
-    detail = '{0} has mtime: {1}'.format(thing, expected)
-    if File(thing).mtime.strftime('%Y-%m-%d %H:%M:%S') == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+
+def _file_size(run, thing, expected):
+    found = run.facts.file(thing).size
+    run.record('file_size', thing, expected, found == expected, found)
 
 
 def file_size(thing, expected):
@@ -335,13 +2041,12 @@ def file_size(thing, expected):
 
         salt '*' infratest.file_size /etc/passwd 128
     '''
-    detail = '{0} has size: {1}'.format(thing, expected)
-    if File(thing).size == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(File(thing).size)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_file_size, thing, expected)
+
+
+def _package_isinstalled(run, thing, expected):
+    found = run.facts.package(thing)[0]
+    run.record('package_isinstalled', thing, expected, found == expected)
 
 
 def package_isinstalled(thing, expected):
@@ -352,12 +2057,14 @@ def package_isinstalled(thing, expected):
 
         salt '*' infratest.package_isinstalled exim4 true
     '''
-    detail = '{0} is installed: {1}'.format(thing, expected)
-    if Package(thing).is_installed == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_package_isinstalled, thing, expected)
+
+
+def _package_version(run, thing, expected):
+    found = run.facts.package(thing)[1]
+    expected = str(expected)
+    run.record('package_version', thing, expected,
+               found is not None and found.startswith(expected), found)
 
 
 def package_version(thing, expected):
@@ -368,33 +2075,38 @@ def package_version(thing, expected):
 
         salt '*' infratest.package_version exim4 2.0-pre4-1
     '''
-    detail = '{0} is version: {1}'.format(thing, str(expected))
-    if Package(thing).version.startswith(str(expected)):
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(Package(thing).version)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_package_version, thing, expected)
 
 
-def process_count(proc_name, owner, expected_count):
+def _process_count(run, proc_name, owner, expected_count, match='exact',
+                   cmdline=None):
+    found = len(run.facts.processes(proc_name, owner, cmdline, match))
+    run.record('process_count', (proc_name, owner), expected_count,
+               found == expected_count, found)
+
+
+def process_count(proc_name, owner, expected_count, match='exact',
+                  cmdline=None):
     '''
     test for number of processes
 
+    match='regex' treats proc_name as a regular expression searched in the
+    process names, and cmdline a regular expression the process' command
+    line has to match
+
     CLI Example::
     checks for 4 instances of sshd that are owned by root
 
         salt '*' infratest.process_count sshd root 4
+        salt '*' infratest.process_count '^php' www 8 match=regex cmdline=pool
     '''
-    proc_count = len(Process.filter(comm=proc_name, user=owner))
-    detail = '{0} has {1} processes running owned by {2}'.format(
-        proc_name, proc_count, owner
-    )
-    if proc_count == expected_count:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(expected_count)
-        INFRATEST['Failed'].append(detail)
+    return _report(_process_count, proc_name, owner, expected_count, match,
+                   cmdline)
+
+
+def _service_isrunning(run, thing, expected):
+    found = run.facts.service(thing).running
+    run.record('service_isrunning', thing, expected, found == expected)
 
 
 def service_isrunning(thing, expected):
@@ -405,12 +2117,12 @@ def service_isrunning(thing, expected):
 
         salt '*' infratest.service_isrunning exim4 true
     '''
-    detail = '{0} is running: {1}'.format(thing, expected)
-    if Service(thing).is_running == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_service_isrunning, thing, expected)
+
+
+def _service_isvalid(run, thing, expected):
+    found = run.facts.service_valid(thing)
+    run.record('service_isvalid', thing, expected, found == expected)
 
 
 def service_isvalid(thing, expected):
@@ -421,17 +2133,12 @@ def service_isvalid(thing, expected):
 
         salt '*' infratest.service_isvalid exim4 true
     '''
-    detail = '{0} is valid: {1}'.format(thing, expected)
+    return _report(_service_isvalid, thing, expected)
 
-    try:
-        check = Service(thing).is_valid
-    # is_valid will always raise an assertion error on failure.
-    except AssertionError:
-        INFRATEST['Failed'].append(detail)
-    else:
-        INFRATEST['Passed'].append(detail)
 
-    return INFRATEST
+def _service_isenabled(run, thing, expected):
+    found = run.facts.service(thing).enabled
+    run.record('service_isenabled', thing, expected, found == expected)
 
 
 def service_isenabled(thing, expected):
@@ -442,12 +2149,12 @@ def service_isenabled(thing, expected):
 
         salt '*' infratest.service_isenabled exim4 true
     '''
-    detail = '{0} is enabled: {1}'.format(thing, expected)
-    if Service(thing).is_enabled == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_service_isenabled, thing, expected)
+
+
+def _socket_islistening(run, thing, expected):
+    found = run.facts.socket_listening(thing)
+    run.record('socket_islistening', thing, expected, found == expected)
 
 
 def socket_islistening(thing, expected):
@@ -458,12 +2165,12 @@ def socket_islistening(thing, expected):
 
         salt '*' infratest.socket_islistening tcp://22 true
     '''
-    detail = '{0} is listening: {1}'.format(thing, expected)
-    if Socket(thing).is_listening == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_socket_islistening, thing, expected)
+
+
+def _user_exists(run, thing, expected):
+    found = run.facts.user(thing) is not None
+    run.record('user_exists', thing, expected, found == expected)
 
 
 def user_exists(thing, expected):
@@ -474,12 +2181,13 @@ def user_exists(thing, expected):
 
         salt '*' infratest.user_exists root true
     '''
-    detail = '{0} exists: {1}'.format(thing, expected)
-    if User(thing).exists == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_user_exists, thing, expected)
+
+
+def _user_uid(run, thing, expected):
+    entry = run.facts.user(thing)
+    found = entry and entry.pw_uid
+    run.record('user_uid', thing, expected, found == expected, found)
 
 
 def user_uid(thing, expected):
@@ -490,13 +2198,13 @@ def user_uid(thing, expected):
 
         salt '*' infratest.user_uid root 0
     '''
-    detail = '{0} has uid: {1}'.format(thing, expected)
-    if User(thing).uid == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(User(thing).uid)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_user_uid, thing, expected)
+
+
+def _user_gid(run, thing, expected):
+    entry = run.facts.user(thing)
+    found = entry and entry.pw_gid
+    run.record('user_gid', thing, expected, found == expected, found)
 
 
 def user_gid(thing, expected):
@@ -507,13 +2215,12 @@ def user_gid(thing, expected):
 
         salt '*' infratest.user_gid root 0
     '''
-    detail = '{0} has gid: {1}'.format(thing, expected)
-    if User(thing).gid == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(User(thing).gid)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_user_gid, thing, expected)
+
+
+def _user_group(run, thing, expected):
+    found = run.facts.user_group(thing)
+    run.record('user_group', thing, expected, found == expected)
 
 
 def user_group(thing, expected):
@@ -524,12 +2231,14 @@ def user_group(thing, expected):
 
         salt '*' infratest.user_group root wheel
     '''
-    detail = '{0} has group: {1}'.format(thing, expected)
-    if User(thing).group == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_user_group, thing, expected)
+
+
+def _user_gids(run, thing, expected):
+    # hack to get around https://github.com/philpep/testinfra/issues/221
+    gids = run.facts.user_gids(thing) or []
+    gidstring = ','.join([str(gid) for gid in gids])
+    run.record('user_gids', thing, expected, gidstring == expected, gids)
 
 
 def user_gids(thing, expected):
@@ -540,15 +2249,15 @@ def user_gids(thing, expected):
 
         salt '*' infratest.user_gids root 0,1,2
     '''
-    detail = '{0} has gids: {1}'.format(thing, expected)
+    return _report(_user_gids, thing, expected)
+
+
+def _user_groups(run, thing, expected):
     # hack to get around https://github.com/philpep/testinfra/issues/221
-    gidstring = ','.join([str(gid) for gid in User(thing).gids])
-    if gidstring == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(User(thing).gids)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    groups = run.facts.user_groups(thing) or []
+    groupstring = ','.join([str(group) for group in groups])
+    run.record('user_groups', thing, expected, groupstring == expected,
+               groupstring)
 
 
 def user_groups(thing, expected):
@@ -559,15 +2268,13 @@ def user_groups(thing, expected):
 
         salt '*' infratest.user_groups root root,wheel
     '''
-    detail = '{0} has groups: {1}'.format(thing, expected)
-    # hack to get around https://github.com/philpep/testinfra/issues/221
-    groupstring = ','.join([str(group) for group in User(thing).groups])
-    if groupstring == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(groupstring)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_user_groups, thing, expected)
+
+
+def _user_home(run, thing, expected):
+    entry = run.facts.user(thing)
+    found = entry and entry.pw_dir
+    run.record('user_home', thing, expected, found == expected, found)
 
 
 def user_home(thing, expected):
@@ -578,13 +2285,13 @@ def user_home(thing, expected):
 
         salt '*' infratest.user_home foo /home/foo
     '''
-    detail = '{0} has home: {1}'.format(thing, expected)
-    if User(thing).home == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(User(thing).home)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_user_home, thing, expected)
+
+
+def _user_shell(run, thing, expected):
+    entry = run.facts.user(thing)
+    found = entry and entry.pw_shell
+    run.record('user_shell', thing, expected, found == expected, found)
 
 
 def user_shell(thing, expected):
@@ -595,13 +2302,12 @@ def user_shell(thing, expected):
 
         salt '*' infratest.user_shell foo /bin/bash
     '''
-    detail = '{0} has shell: {1}'.format(thing, expected)
-    if User(thing).shell == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(User(thing).shell)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_user_shell, thing, expected)
+
+
+def _group_exists(run, thing, expected):
+    found = run.facts.group(thing) is not None
+    run.record('group_exists', thing, expected, found == expected)
 
 
 def group_exists(thing, expected):
@@ -612,12 +2318,13 @@ def group_exists(thing, expected):
 
         salt '*' infratest.group_exists bar true
     '''
-    detail = '{0} exists: {1}'.format(thing, expected)
-    if Group(thing).exists == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_group_exists, thing, expected)
+
+
+def _group_gid(run, thing, expected):
+    entry = run.facts.group(thing)
+    found = entry and entry.gr_gid
+    run.record('group_gid', thing, expected, found == expected, found)
 
 
 def group_gid(thing, expected):
@@ -628,13 +2335,12 @@ def group_gid(thing, expected):
 
         salt '*' infratest.group_gid bar 2
     '''
-    detail = '{0} has gid: {1}'.format(thing, expected)
-    if Group(thing).gid == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(Group(thing).gid)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_group_gid, thing, expected)
+
+
+def _interface_exists(run, thing, expected):
+    found = run.facts.interface_exists(thing)
+    run.record('interface_exists', thing, expected, found == expected)
 
 
 def interface_exists(thing, expected):
@@ -645,12 +2351,12 @@ def interface_exists(thing, expected):
 
         salt '*' infratest.interface_exists eth1 true
     '''
-    detail = '{0} exists: {1}'.format(thing, expected)
-    if Interface(thing).exists == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_interface_exists, thing, expected)
+
+
+def _interface_speed(run, thing, expected):
+    found = run.facts.interface_speed(thing)
+    run.record('interface_speed', thing, expected, found == expected, found)
 
 
 def interface_speed(thing, expected):
@@ -661,30 +2367,35 @@ def interface_speed(thing, expected):
 
         salt '*' infratest.interface_speed eth0 1000
     '''
-    detail = '{0} has speed: {1}'.format(thing, expected)
-    if Interface(thing).speed == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(Interface(thing).speed)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_interface_speed, thing, expected)
+
+
+def _interface_address(run, thing, expected):
+    if not isinstance(expected, (list, tuple)):
+        expected = [expected]
+    found = run.facts.interface_addresses(thing)
+    for address in expected:
+        if address in found:
+            run.record('interface_address', thing, address, True)
+        else:
+            run.record('interface_address', thing, address, False,
+                       sorted(found))
 
 
 def interface_address(thing, expected):
     '''
-    test if an interface has the set address
+    test if an interface has the set address, or each address of a list
 
     CLI Example::
 
         salt '*' infratest.interface_address eth0 192.168.1.2
     '''
-    detail = '{0} has address: {1}'.format(thing, expected)
-    if expected in Interface(thing).addresses:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(Interface(thing).addresses)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_interface_address, thing, expected)
+
+
+def _systeminfo_type(run, expected):
+    found = _host().system_info.type
+    run.record('systeminfo_type', None, expected, found == expected, found)
 
 
 def systeminfo_type(expected):
@@ -695,13 +2406,13 @@ def systeminfo_type(expected):
 
         salt '*' infratest.systeminfo_type linux
     '''
-    detail = 'type: {0}'.format(expected)
-    if SystemInfo.type == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(SystemInfo.type)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_systeminfo_type, expected)
+
+
+def _systeminfo_distribution(run, expected):
+    found = _host().system_info.distribution
+    run.record('systeminfo_distribution', None, expected, found == expected,
+               found)
 
 
 def systeminfo_distribution(expected):
@@ -712,13 +2423,12 @@ def systeminfo_distribution(expected):
 
         salt '*' infratest.systeminfo_distribution debian
     '''
-    detail = 'distribution: {0}'.format(expected)
-    if SystemInfo.distribution == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(SystemInfo.distribution)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_systeminfo_distribution, expected)
+
+
+def _systeminfo_release(run, expected):
+    found = _host().system_info.release
+    run.record('systeminfo_release', None, expected, found == expected, found)
 
 
 def systeminfo_release(expected):
@@ -729,13 +2439,12 @@ def systeminfo_release(expected):
 
         salt '*' infratest.systeminfo_release '8.3'
     '''
-    detail = 'release: {0}'.format(expected)
-    if SystemInfo.release == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(SystemInfo.release)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_systeminfo_release, expected)
+
+
+def _systeminfo_codename(run, expected):
+    found = _host().system_info.codename
+    run.record('systeminfo_codename', None, expected, found == expected, found)
 
 
 def systeminfo_codename(expected):
@@ -746,14 +2455,15 @@ def systeminfo_codename(expected):
 
         salt '*' infratest.systeminfo_codename sarge
     '''
+    return _report(_systeminfo_codename, expected)
+
 
-    detail = 'codename: {0}'.format(expected)
-    if SystemInfo.codename == expected:
-        INFRATEST['Passed'].append(detail)
+def _sysctl(run, thing, expected):
+    found = run.facts.sysctl(thing)
+    if found is None:
+        run.record('sysctl_invalid', thing, expected, False)
     else:
-        detail += ', found: {}'.format(SystemInfo.codename)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+        run.record('sysctl', thing, expected, found == expected, found)
 
 
 def sysctl(thing, expected):
@@ -764,21 +2474,12 @@ def sysctl(thing, expected):
 
         salt '*' infratest.sysctl vm.dirty_ratio 20
     '''
+    return _report(_sysctl, thing, expected)
 
-    detail = '{0}: {1}'.format(thing, expected)
-    try:
-        check = Sysctl(thing)
-    except AssertionError:
-        detail = '{} is not a valid sysctl setting'.format(thing)
-        INFRATEST['Failed'].append(detail)
-        return INFRATEST
-
-    if check == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(Sysctl(thing))
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+
+def _mount_exists(run, thing, expected):
+    found = run.facts.mount(thing) is not None
+    run.record('mount_exists', thing, expected, found == expected)
 
 
 def mount_exists(thing, expected):
@@ -788,12 +2489,13 @@ def mount_exists(thing, expected):
     CLI Example::
         salt '*' infratest.mount_exists '/' true
     '''
-    detail = '{0} mount exists: {1}'.format(thing, expected)
-    if Mount(thing).exists == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_mount_exists, thing, expected)
+
+
+def _mount_filesystem(run, thing, expected):
+    mount = run.facts.mount(thing)
+    found = mount and mount.filesystem
+    run.record('mount_filesystem', thing, expected, found == expected, found)
 
 
 def mount_filesystem(thing, expected):
@@ -803,13 +2505,13 @@ def mount_filesystem(thing, expected):
     CLI Example::
         salt '*' infratest.mount_filesystem 'ext4'
     '''
-    detail = '{0} has {1} file system.'.format(thing, expected)
-    if Mount(thing).filesystem == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(Mount(thing).filesystem)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_mount_filesystem, thing, expected)
+
+
+def _mount_device(run, thing, expected):
+    mount = run.facts.mount(thing)
+    found = mount and mount.device
+    run.record('mount_device', thing, expected, found == expected, found)
 
 
 def mount_device(thing, expected):
@@ -819,195 +2521,1301 @@ def mount_device(thing, expected):
     CLI Example::
         salt '*' infratest.mount_device '/' '/dev/sda1'
     '''
-    detail = '{0} is mounted to {1} device.'.format(thing, expected)
-    if Mount(thing).device == expected:
-        INFRATEST['Passed'].append(detail)
-    else:
-        detail += ', found: {}'.format(Mount(thing).device)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+    return _report(_mount_device, thing, expected)
+
+
+def _option_list(expected):
+    '''
+    return mount options given as a comma separated string or a list as a
+    tuple
+    '''
+    if not isinstance(expected, (list, tuple)):
+        expected = str(expected).split(',')
+    return tuple(expected)
+
+
+def _mount_options(run, thing, expected):
+    expected = _option_list(expected)
+    mount = run.facts.mount(thing)
+    run.record('mount_options', thing, expected,
+               mount is not None and mount.option_set.issuperset(expected),
+               mount and mount.options)
 
 
 def mount_options(thing, expected):
     '''
-    test if a mount is present
+    test if a mount has all of the options given, as a comma separated
+    string or a list
 
     CLI Example::
         salt '*' infratest.mount_options '/' 'rw,relatime,data=ordered'
     '''
-    detail = '{0} has {1}'.format(thing, expected)
-    # hack done to circumvent: https://github.com/philpep/testinfra/issues/221
-    mountstring = ','.join([str(option) for option in Mount(thing).options])
-    if expected == mountstring:
-        INFRATEST['Passed'].append(detail)
+    return _report(_mount_options, thing, expected)
+
+
+# check kind => check function, the plan refers to checks by kind
+_CHECKS = {
+    'file_exists': _file_exists,
+    'file_isfile': _file_isfile,
+    'file_isdir': _file_isdir,
+    'file_ispipe': _file_ispipe,
+    'file_issocket': _file_issocket,
+    'file_issymlink': _file_issymlink,
+    'file_badtype': _file_badtype,
+    'file_glob': _file_glob,
+    'file_linkedto': _file_linkedto,
+    'file_user': _file_user,
+    'file_group': _file_group,
+    'file_uid': _file_uid,
+    'file_gid': _file_gid,
+    'file_mode': _file_mode,
+    'file_contains': _file_contains,
+    'file_md5sum': _file_md5sum,
+    'file_sha256sum': _file_sha256sum,
+    'file_mtime': _file_mtime,
+    'file_size': _file_size,
+    'package_isinstalled': _package_isinstalled,
+    'package_version': _package_version,
+    'process_count': _process_count,
+    'service_isrunning': _service_isrunning,
+    'service_isenabled': _service_isenabled,
+    'service_isvalid': _service_isvalid,
+    'socket_islistening': _socket_islistening,
+    'user_exists': _user_exists,
+    'user_uid': _user_uid,
+    'user_gid': _user_gid,
+    'user_group': _user_group,
+    'user_gids': _user_gids,
+    'user_groups': _user_groups,
+    'user_home': _user_home,
+    'user_shell': _user_shell,
+    'group_exists': _group_exists,
+    'group_gid': _group_gid,
+    'interface_exists': _interface_exists,
+    'interface_speed': _interface_speed,
+    'interface_address': _interface_address,
+    'systeminfo_type': _systeminfo_type,
+    'systeminfo_distribution': _systeminfo_distribution,
+    'systeminfo_release': _systeminfo_release,
+    'systeminfo_codename': _systeminfo_codename,
+    'sysctl': _sysctl,
+    'mount_exists': _mount_exists,
+    'mount_filesystem': _mount_filesystem,
+    'mount_device': _mount_device,
+    'mount_options': _mount_options,
+}
+
+# pillar section => (pillar attribute, check kind) pairs, in the order the
+# checks run. file types and the process, systeminfo and sysctl sections
+# are compiled by _compile()
+_ATTRIBUTES = (
+    ('file', (
+        ('exists', 'file_exists'),
+        ('type', None),
+        ('linkedto', 'file_linkedto'),
+        ('user', 'file_user'),
+        ('group', 'file_group'),
+        ('uid', 'file_uid'),
+        ('gid', 'file_gid'),
+        ('mode', 'file_mode'),
+        ('contains', 'file_contains'),
+        ('md5sum', 'file_md5sum'),
+        ('sha256sum', 'file_sha256sum'),
+        ('mtime', 'file_mtime'),
+        ('size', 'file_size'),
+    )),
+    ('package', (
+        ('installed', 'package_isinstalled'),
+        ('version', 'package_version'),
+    )),
+    ('process', None),
+    ('service', (
+        ('running', 'service_isrunning'),
+        ('enabled', 'service_isenabled'),
+        ('valid', 'service_isvalid'),
+    )),
+    ('socket', (
+        ('listening', 'socket_islistening'),
+    )),
+    ('user', (
+        ('exists', 'user_exists'),
+        ('uid', 'user_uid'),
+        ('gid', 'user_gid'),
+        ('group', 'user_group'),
+        ('gids', 'user_gids'),
+        ('groups', 'user_groups'),
+        ('home', 'user_home'),
+        ('shell', 'user_shell'),
+    )),
+    ('group', (
+        ('exists', 'group_exists'),
+        ('gid', 'group_gid'),
+    )),
+    ('interface', (
+        ('exists', 'interface_exists'),
+        ('speed', 'interface_speed'),
+        ('addresses', 'interface_address'),
+    )),
+    ('systeminfo', None),
+    ('sysctl', None),
+    ('mount', (
+        ('exists', 'mount_exists'),
+        ('filesystem', 'mount_filesystem'),
+        ('device', 'mount_device'),
+        ('options', 'mount_options'),
+    )),
+)
+
+_FILE_TYPES = {
+    'file': 'file_isfile',
+    'directory': 'file_isdir',
+    'pipe': 'file_ispipe',
+    'socket': 'file_issocket',
+    'symlink': 'file_issymlink',
+}
+
+# expected values normalised once when the plan is compiled
+_NORMALIZE = {
+    'file_mode': _mode_string,
+    'mount_options': _option_list,
+}
+
+_SYSTEMINFO = ('type', 'distribution', 'release', 'codename')
+
+# a single compiled check. args are the positional arguments of the check
+# function after the run
+_Check = collections.namedtuple('_Check', 'kind target expected args')
+
+# (pillar hash, plan) of the last pillar compiled
+_PLAN = (None, ())
+_PLAN_LOCK = threading.Lock()
+
+
+def _check(kind, target, expected):
+    normalize = _NORMALIZE.get(kind)
+    if normalize is not None:
+        expected = normalize(expected)
+    return _Check(kind, target, expected, (target, expected))
+
+
+def _compile(tests):
+    '''
+    compile the infratest pillar into a tuple of _Check records
+    '''
+    plan = []
+    for section, attributes in _ATTRIBUTES:
+        if section not in tests:
+            continue
+        if section == 'process':
+            for proc, vals in tests['process'].items():
+                for owner, options in vals.items():
+                    if 'count' in options:
+                        args = (proc, owner, options['count'],
+                                options.get('match', 'exact'),
+                                options.get('cmdline'))
+                        plan.append(_Check(
+                            'process_count', proc, options['count'], args))
+        elif section == 'systeminfo':
+            for attribute in _SYSTEMINFO:
+                if attribute in tests['systeminfo']:
+                    expected = tests['systeminfo'][attribute]
+                    plan.append(_Check('systeminfo_' + attribute, None,
+                                       expected, (expected,)))
+        elif section == 'sysctl':
+            for key, vals in tests['sysctl'].items():
+                plan.append(_check('sysctl', key, vals['value']))
+        else:
+            for key, vals in tests[section].items():
+                for attribute, kind in attributes:
+                    if attribute not in vals:
+                        continue
+                    if kind is None:
+                        kind = _FILE_TYPES.get(vals[attribute], 'file_badtype')
+                    plan.append(_check(kind, key, vals[attribute]))
+    return tuple(plan)
+
+
+def _pillar_hash(tests):
+    try:
+        encoded = json.dumps(tests, sort_keys=True, default=repr)
+    except TypeError:
+        # keys of mixed types can not be sorted, a pillar renders the same
+        # way every time so its repr does as a key
+        encoded = repr(tests)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def _plan(tests):
+    '''
+    return the compiled plan for the infratest pillar
+
+    the last plan is kept keyed by a hash of the pillar, so scheduled runs
+    over an unchanged pillar skip compiling it
+    '''
+    global _PLAN
+    digest = _pillar_hash(tests)
+    with _PLAN_LOCK:
+        if _PLAN[0] != digest:
+            _PLAN = (digest, _compile(tests))
+        return _PLAN[1]
+
+
+def _expand(run, plan, workers=1, deadlines=None):
+    '''
+    return plan with the file checks of glob targets replaced by the same
+    checks on every path the glob matches
+
+    a glob that matches nothing is checked as the literal path, so exists
+    False passes and anything else fails. with deadlines the globs are
+    walked like checks, a walk stuck on a dead mount is recorded as timed
+    out and the checks of its glob are left out.
+    '''
+    def is_glob(check):
+        return (check.kind.startswith('file_') and
+                _GLOB_MAGIC.search(check.target) is not None)
+
+    if not any(is_glob(check) for check in plan):
+        return plan
+    missed = set()
+    if deadlines is not None:
+        patterns = []
+        for check in plan:
+            if is_glob(check) and check.target not in patterns:
+                patterns.append(check.target)
+        walks = [_Check('file_glob', pattern, None, (pattern,))
+                 for pattern in patterns]
+        forks = [run.fork() for _ in walks]
+        for walk, _ in _dispatch(list(zip(walks, forks)), workers,
+                                 deadlines=deadlines):
+            missed.add(walk.target)
+        for fork in forks:
+            run.merge(fork)
+    expanded = []
+    index = 0
+    while index < len(plan):
+        check = plan[index]
+        if not is_glob(check):
+            expanded.append(check)
+            index += 1
+            continue
+        # the checks of one pillar entry are next to each other in the plan
+        end = index + 1
+        while (end < len(plan) and plan[end].target == check.target and
+               plan[end].kind.startswith('file_')):
+            end += 1
+        group = plan[index:end]
+        index = end
+        if check.target in missed:
+            continue
+        paths = run.facts.glob(check.target)
+        if not paths:
+            expanded.extend(group)
+            continue
+        for path in paths:
+            for check in group:
+                expanded.append(check._replace(target=path,
+                                               args=(path,) + check.args[1:]))
+    return tuple(expanded)
+
+
+def _prepare(run, plan):
+    '''
+    tell the run's facts what the plan will ask for
+    '''
+    for check in plan:
+        if check.kind == 'file_md5sum':
+            run.facts.want_digest(check.target, 'md5')
+        elif check.kind == 'file_sha256sum':
+            run.facts.want_digest(check.target, 'sha256')
+        elif check.kind == 'sysctl':
+            run.facts.sysctl_keys.add(check.target)
+    if run.facts.wanted:
+        run.facts.digest_cache = _digest_cache()
+
+
+def _run_check(check, run):
+    if run.profile is not None:
+        run.profile.measure(check, _CHECKS[check.kind], run)
+    else:
+        _CHECKS[check.kind](run, *check.args)
+
+
+class _Deadlines(object):
+    '''
+    the per check timeout and the total budget of a run_all call, in
+    seconds, either may be None
+    '''
+
+    def __init__(self, timeout=None, budget=None):
+        self.timeout = timeout
+        self.until = None if budget is None else time.time() + budget
+        # checks that timed out or never started
+        self.missed = 0
+
+    def expires(self, started):
+        '''
+        return when a check started at started has to be done by
+        '''
+        if self.timeout is None:
+            return self.until
+        if self.until is None:
+            return started + self.timeout
+        return min(started + self.timeout, self.until)
+
+    def used_up(self, now):
+        return self.until is not None and now >= self.until
+
+    def describe(self, check):
+        if check.target is None:
+            return check.kind
+        return '{0} {1}'.format(check.target, check.kind)
+
+
+def _dispatch_deadlines(pairs, workers, done, deadlines, run_check):
+    '''
+    run each check of pairs into its run on at most workers daemon threads,
+    and return the pairs that timed out or did not start before the run
+    budget was used up
+
+    the threads take the checks from pairs themselves, the calling thread
+    only wakes up when a check may have expired. a check still running when
+    it expires is recorded as failed and left behind: its thread may stay
+    blocked (on a dead nfs mount, a wedged d-bus, ...), so a new thread
+    takes its place. checks run into a scratch fork of their run that is
+    only merged if the check finished in time, a late result is dropped
+    instead of counted next to the timeout. a check whose command was killed
+    at the deadline is recorded as timed out by its own thread.
+    '''
+    pending = collections.deque(pairs)
+    cond = threading.Condition()
+    # key => (check, run, expires, started) of the running checks
+    active = {}
+    missed = []
+    errors = []
+    state = {'key': 0, 'workers': 0}
+
+    def give_up(key):
+        # called with cond held
+        check, run, expires, started = active.pop(key)
+        budget = deadlines.until is not None and expires >= deadlines.until
+        result = _Result('check_timeout', deadlines.describe(check),
+                         None if budget else deadlines.timeout, False, None)
+        LOG.warning('infratest: %s', result.message())
+        run.record(*result)
+        missed.append((check, run))
+        return started
+
+    def worker():
+        while True:
+            with cond:
+                now = time.time()
+                if errors or not pending or deadlines.used_up(now):
+                    state['workers'] -= 1
+                    cond.notify()
+                    return
+                check, run = pending.popleft()
+                state['key'] += 1
+                key = state['key']
+                expires = deadlines.expires(now)
+                active[key] = (check, run, expires, now)
+            _DEADLINE.at = expires
+            scratch = run.fork()
+            try:
+                run_check(check, scratch)
+            except _CommandTimeout:
+                with cond:
+                    if key not in active:
+                        return
+                    give_up(key)
+                if done is not None:
+                    done(check, run, time.time() - now)
+                continue
+            except BaseException as exc:
+                with cond:
+                    if key in active:
+                        del active[key]
+                        errors.append(exc)
+                        state['workers'] -= 1
+                        cond.notify()
+                    return
+            with cond:
+                if key not in active:
+                    # given up on, another thread took this one's place
+                    return
+                del active[key]
+                run.merge(scratch)
+            if done is not None:
+                done(check, run, time.time() - now)
+
+    def start():
+        state['workers'] += 1
+        thread = threading.Thread(target=worker, name='infratest check')
+        thread.daemon = True
+        thread.start()
+
+    with cond:
+        for _ in range(min(max(workers, 1), len(pending))):
+            start()
+        while state['workers'] and not errors:
+            now = time.time()
+            for key, (check, run, expires, started) in list(active.items()):
+                if expires > now:
+                    continue
+                give_up(key)
+                state['workers'] -= 1
+                start()
+                if done is not None:
+                    done(check, run, now - started)
+            # checks started from now on expire no earlier than this
+            first = deadlines.expires(now)
+            for _, _, expires, _ in active.values():
+                first = min(first, expires)
+            cond.wait(max(first - now, 0))
+    if errors:
+        raise errors[0]
+    for check, run in pending:
+        run.record('check_skipped', deadlines.describe(check), None, False)
+        missed.append((check, run))
+        if done is not None:
+            done(check, run, 0.0)
+    deadlines.missed += len(missed)
+    return missed
+
+
+def _dispatch(pairs, workers=1, done=None, deadlines=None,
+              run_check=_run_check):
+    '''
+    run each check of pairs, a list of (check, run) pairs, into its run, and
+    return the pairs that missed their deadlines
+
+    done, when given, is called with each check, its run and the seconds it
+    took as soon as the check finished, from the worker thread that ran it.
+    run_check(check, run) is what runs a check, under its deadline.
+    '''
+    if deadlines is not None:
+        return _dispatch_deadlines(pairs, workers, done, deadlines, run_check)
+
+    def call(check, run):
+        if done is None:
+            run_check(check, run)
+            return
+        started = time.time()
+        run_check(check, run)
+        done(check, run, time.time() - started)
+
+    if workers > 1 and HAS_FUTURES and len(pairs) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = [pool.submit(call, check, run) for check, run in pairs]
+            for future in futures:
+                future.result()
+        finally:
+            pool.shutdown()
     else:
-        detail += ', found: {}'.format(mountstring)
-        INFRATEST['Failed'].append(detail)
-    return INFRATEST
+        for check, run in pairs:
+            call(check, run)
+    return []
+
+
+def _execute(run, plan, workers=1, done=None, deadlines=None):
+    '''
+    run the checks of plan, recording into run
+
+    with more than one worker, a done callback or deadlines for _dispatch,
+    the checks run each into its own forked run. those are merged back in
+    plan order, so the results come out in the same order as a serial run.
+    '''
+    parallel = workers > 1 and HAS_FUTURES and len(plan) > 1
+    if done is not None and deadlines is None and not parallel:
+        # one fork at a time, a serial run need not hold a fork per check
+        for check in plan:
+            fork = run.fork()
+            _dispatch([(check, fork)], done=done)
+            run.merge(fork)
+    elif done is not None or deadlines is not None or parallel:
+        forks = [run.fork() for _ in plan]
+        _dispatch(list(zip(plan, forks)), workers, done, deadlines)
+        for fork in forks:
+            run.merge(fork)
+    else:
+        _dispatch([(check, run) for check in plan])
+
+
+def _stat_key(path, started):
+    '''
+    return what identifies the current state of path, following a symlink
+    to its target, None for a missing path or False when path changed too
+    recently to tell a later change within the same timestamp apart
+    '''
+    key = []
+    for stat_func in (os.lstat, os.stat):
+        try:
+            st = stat_func(path)
+        except OSError:
+            key.append(None)
+            break
+        if st.st_ctime_ns >= (started - _RACY_SECONDS) * 1e9:
+            return False
+        key.append([st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                    st.st_ctime_ns, st.st_mode, st.st_uid, st.st_gid])
+        if not stat.S_ISLNK(st.st_mode):
+            break
+    return key
+
 
+def _unit_dirs():
+    '''
+    return the systemd unit directories and their .wants/.requires
+    subdirectories, where enabling a unit adds links
+    '''
+    dirs = []
+    for directory in _UNIT_DIRS:
+        dirs.append(directory)
+        try:
+            entries = sorted(os.listdir(directory))
+        except OSError:
+            continue
+        dirs.extend(os.path.join(directory, name) for name in entries
+                    if name.endswith(('.wants', '.requires')))
+    return tuple(dirs)
 
-def run_all(details=False):
+
+def _local_accounts():
+    '''
+    return whether nsswitch.conf looks up passwd and group only in the local
+    files, as do systems without one
+    '''
+    sources = {}
     try:
-        __salt__
-    except:
-        return (False, 'could not get infratest pillar data')
+        with open(_NSSWITCH) as handle:
+            for line in handle:
+                database, _, rest = line.partition('#')[0].partition(':')
+                sources[database.strip()] = [
+                    source for source in rest.split()
+                    if not source.startswith('[')]
+    except EnvironmentError:
+        return True
+    return all(set(sources.get(database, ())) <= set(_LOCAL_SOURCES)
+               for database in ('passwd', 'group'))
+
+
+def _local_names(path):
+    '''
+    return the names of the accounts in a passwd or group file
+    '''
+    try:
+        with open(path) as handle:
+            return set(line.partition(':')[0] for line in handle)
+    except EnvironmentError:
+        return set()
+
+
+def _account_inputs(check, facts):
+    '''
+    return the inputs of a check on accounts, None when it may depend on
+    accounts that are not in the local files (ldap, sssd, ...)
+    '''
+    inputs = _ACCOUNT_DBS + (_NSSWITCH,)
+    if facts._once('local accounts', _local_accounts):
+        return inputs
+    # with other sources, only a local account is known not to come from
+    # them. membership and owner lookups may involve any account.
+    if check.kind.startswith('user_') and check.kind not in (
+            'user_group', 'user_gids', 'user_groups'):
+        path = _ACCOUNT_DBS[0]
+    elif check.kind.startswith('group_'):
+        path = _ACCOUNT_DBS[1]
     else:
-        tests = __salt__['pillar.get']('infratest')
-
-    if 'file' in tests:
-        for key, vals in tests['file'].items():
-            if 'exists' in vals:
-                file_exists(key, vals['exists'])
-            if 'type' in vals:
-                if vals['type'] == 'file':
-                    file_isfile(key, vals['type'])
-                elif vals['type'] == 'directory':
-                    file_isdir(key, vals['type'])
-                elif vals['type'] == 'pipe':
-                    file_ispipe(key, vals['type'])
-                elif vals['type'] == 'socket':
-                    file_issocket(key, vals['type'])
-                elif vals['type'] == 'symlink':
-                    file_issymlink(key, vals['type'])
-                else:
-                    INFRATEST['Failed'].append(
-                        "{0} could not find a type match: {1}".format(key, vals['type']))
-            if 'linkedto' in vals:
-                file_linkedto(key, vals['linkedto'])
-            if 'user' in vals:
-                file_user(key, vals['user'])
-            if 'group' in vals:
-                file_group(key, vals['group'])
-            if 'uid' in vals:
-                file_uid(key, vals['uid'])
-            if 'gid' in vals:
-                file_gid(key, vals['gid'])
-            if 'mode' in vals:
-                file_mode(key, vals['mode'])
-            if 'contains' in vals:
-                if type(vals['contains']) == list:
-                    for content in vals['contains']:
-                        file_contains(key, content)
-                else:
-                    file_contains(key, vals['contains'])
-            if 'md5sum' in vals:
-                file_md5sum(key, vals['md5sum'])
-            if 'sha256sum' in vals:
-                file_sha256sum(key, vals['sha256sum'])
-            if 'mtime' in vals:
-                file_mtime(key, vals['mtime'])
-            if 'size' in vals:
-                file_size(key, vals['size'])
-
-    if 'package' in tests:
-        for key, vals in tests['package'].items():
-            if 'installed' in vals:
-                package_isinstalled(key, vals['installed'])
-            if 'version' in vals:
-                package_version(key, vals['version'])
-
-    if 'process' in tests:
-        for proc, vals in tests['process'].items():
-            for owner, options in vals.items():
-                if 'count' in options:
-                    process_count(proc, owner, options['count'])
-
-    if 'service' in tests:
-        for key, vals in tests['service'].items():
-            if 'running'in vals:
-                service_isrunning(key, vals['running'])
-            if 'enabled' in vals:
-                service_isenabled(key, vals['enabled'])
-            if 'valid' in vals:
-                service_isvalid(key, vals['valid'])
-
-    if 'socket' in tests:
-        for key, vals in tests['socket'].items():
-            if 'listening' in vals:
-                socket_islistening(key, vals['listening'])
-
-    if 'user' in tests:
-        for key, vals in tests['user'].items():
-            if 'exists' in vals:
-                user_exists(key, vals['exists'])
-            if 'uid' in vals:
-                user_uid(key, vals['uid'])
-            if 'gid' in vals:
-                user_gid(key, vals['gid'])
-            if 'group' in vals:
-                user_group(key, vals['group'])
-            if 'gids' in vals:
-                user_gids(key, vals['gids'])
-            if 'groups' in vals:
-                user_groups(key, vals['groups'])
-            if 'home' in vals:
-                user_home(key, vals['home'])
-            if 'shell' in vals:
-                user_shell(key, vals['shell'])
-
-    if 'group' in tests:
-        for key, vals in tests['group'].items():
-            if 'exists' in vals:
-                group_exists(key, vals['exists'])
-            if 'gid' in vals:
-                group_gid(key, vals['gid'])
-
-    if 'interface' in tests:
-        for key, vals in tests['interface'].items():
-            if 'exists' in vals:
-                interface_exists(key, vals['exists'])
-            if 'speed' in vals:
-                interface_speed(key, vals['speed'])
-            if 'addresses' in vals:
-                if type(vals['addresses']) == list:
-                    # list of addresses
-                    for address in vals['addresses']:
-                        interface_address(key, address)
-                else:
-                    # single address, string
-                    interface_address(key, vals['addresses'])
-
-    if 'systeminfo' in tests:
-        if 'type' in tests['systeminfo']:
-            systeminfo_type(tests['systeminfo']['type'])
-        if 'distribution' in tests['systeminfo']:
-            systeminfo_distribution(tests['systeminfo']['distribution'])
-        if 'release' in tests['systeminfo']:
-            systeminfo_release(tests['systeminfo']['release'])
-        if 'codename' in tests['systeminfo']:
-            systeminfo_codename(tests['systeminfo']['codename'])
-
-    if 'sysctl' in tests:
-        for key, vals in tests['sysctl'].items():
-            sysctl(key, vals['value'])
-
-    if 'mount' in tests:
-        for key, vals in tests['mount'].items():
-            if 'exists'in vals:
-                mount_exists(key, vals['exists'])
-            if 'filesystem'in vals:
-                mount_filesystem(key, vals['filesystem'])
-            if 'device'in vals:
-                mount_device(key, vals['device'])
-            if 'options'in vals:
-                if type(vals['options']) == list:
-                    # list of options
-                    for option in vals['options']:
-                        mount_options(key, option)
-                else:
-                    mount_options(key, vals['options'])
+        return None
+    if check.target in facts._once(('local names', path),
+                                   lambda: _local_names(path)):
+        return inputs
+    return None
+
+
+def _inputs(check, facts):
+    '''
+    return the paths whose state decides the result of check, None when it
+    has to run every time (running services, processes, sockets, ...)
+    '''
+    category = check.kind.partition('_')[0]
+    if check.kind in ('file_user', 'file_group'):
+        accounts = _account_inputs(check, facts)
+        return None if accounts is None else (check.target,) + accounts
+    if category == 'file':
+        return (check.target,)
+    if category == 'package':
+        return _PACKAGE_DBS
+    if category in ('user', 'group'):
+        return _account_inputs(check, facts)
+    if category == 'systeminfo':
+        return ('/etc/os-release',)
+    if check.kind in ('service_isenabled', 'service_isvalid'):
+        # without systemd the state comes from testinfra, from init scripts
+        # and rc links anywhere
+        if facts._once('services', _services) is None:
+            return None
+        return facts._once('unit dirs', _unit_dirs)
+    return None
+
+
+def _fingerprint(check, facts, started):
+    '''
+    return a fingerprint of the inputs of check, None when there is none
+    '''
+    inputs = _inputs(check, facts)
+    if inputs is None:
+        return None
+    fingerprint = []
+    for path in inputs:
+        key = facts._once(('stat key', path), lambda: _stat_key(path, started))
+        if key is False:
+            return None
+        fingerprint.append(key)
+    return fingerprint
+
+
+def _execute_incremental(run, plan, workers, cache, done=None, deadlines=None):
+    '''
+    run the checks of plan whose inputs changed since cache was saved,
+    reusing the stored results of the others, and return how many were
+    reused
+
+    every check runs again once infratest:full_refresh seconds (an hour by
+    default) passed since the last full run. fingerprints are taken as part
+    of each check, under its deadline, and checks that missed their
+    deadlines are not stored.
+    '''
+    started = time.time()
+    full = started - cache.refreshed >= float(_config('full_refresh', 3600))
+    pairs = [(check, run.fork()) for check in plan]
+    keys = [json.dumps([check.kind, check.args], default=repr)
+            for check in plan]
+    index = dict((id(check), key) for check, key in zip(plan, keys))
+    # key => fingerprint, and the keys whose stored results were replayed
+    fingerprints = {}
+    replayed = set()
+
+    def run_check(check, fork):
+        key = index[id(check)]
+        fingerprint = _fingerprint(check, run.facts, started)
+        stored = None if full else cache.get(key, fingerprint)
+        if stored is None:
+            _run_check(check, fork)
+        else:
+            for result in stored:
+                fork.record(*result)
+            replayed.add(key)
+        if fingerprint is not None:
+            fingerprints[key] = fingerprint
+
+    missed = _dispatch(pairs, workers, done, deadlines, run_check)
+    # a check given up on may still finish, and fingerprint, late
+    missed = set(id(fork) for _, fork in missed)
+    entries = {}
+    reused = 0
+    for (check, fork), key in zip(pairs, keys):
+        run.merge(fork)
+        if id(fork) in missed:
+            continue
+        if key in fingerprints:
+            entries[key] = {'fingerprint': fingerprints[key],
+                            'results': fork.passed + fork.failed}
+        if key in replayed:
+            reused += 1
+    cache.save(entries, started if full else cache.refreshed)
+    return reused
+
+
+class _EventBatcher(object):
+    '''
+    sends the results of finished checks to the salt event bus
+
+    results are sent on tag + '/results' in batches of up to size results,
+    or by a timer once the oldest unsent result is interval seconds old,
+    even while the next check is still running. close() sends what is left
+    and the totals on tag + '/complete'.
+    '''
+
+    def __init__(self, send, tag, total, size=100, interval=5):
+        self.send = send
+        self.tag = tag
+        self.total = total
+        self.size = size
+        self.interval = interval
+        self.done = 0
+        self.passed = []
+        self.failed = []
+        self.since = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, check, run, seconds):
+        with self.lock:
+            self.done += 1
+            self.passed.extend(run.passed)
+            self.failed.extend(run.failed)
+            if self.since is None:
+                self.since = time.time()
+            if (len(self.passed) + len(self.failed) >= self.size or
+                    time.time() - self.since >= self.interval):
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(
+                    self.since + self.interval - time.time(), self._expire)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _expire(self):
+        with self.lock:
+            if self.timer is threading.current_thread():
+                self._flush()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.passed or self.failed:
+            self.send(self.tag + '/results', {
+                'Passed': [result.message() for result in self.passed],
+                'Failed': [result.message() for result in self.failed],
+                'Done': self.done, 'Total': self.total})
+        self.passed = []
+        self.failed = []
+        self.since = None
+
+    def close(self, totals):
+        with self.lock:
+            self._flush()
+            self.send(self.tag + '/complete', totals)
+
+
+def _event_batcher(total):
+    '''
+    return an _EventBatcher sending through event.send
+
+    configured with infratest:event_tag, infratest:event_batch_size and
+    infratest:event_batch_seconds
+    '''
+    return _EventBatcher(__salt__['event.send'],
+                         _config('event_tag', 'infratest/run_all'), total,
+                         int(_config('event_batch_size', 100)),
+                         float(_config('event_batch_seconds', 5)))
+
+
+class _Writer(object):
+    '''
+    writes the results of finished checks to a file as they come in
+
+    output is a path, which is created and closed by the writer, or an open
+    file object, which is only flushed
+    '''
+
+    def __init__(self, output):
+        if isinstance(output, str):
+            self.out = open(output, 'w')
+            self.owned = True
+        else:
+            self.out = output
+            self.owned = False
+        self.lock = threading.Lock()
+        self.begin()
+
+    @staticmethod
+    def fields(result, seconds):
+        '''
+        return the structured fields of a result
+        '''
+        kind, _, attribute = result.kind.partition('_')
+        target = result.target
+        if isinstance(target, (list, tuple)):
+            # process_count, name and owner
+            target = ' '.join(str(part) for part in target)
+        return {'kind': kind, 'target': target, 'attribute': attribute,
+                'expected': result.expected, 'found': result.found,
+                'duration': round(seconds, 6),
+                'status': 'passed' if result.ok else 'failed'}
+
+    def add(self, check, run, seconds):
+        with self.lock:
+            for result in run.passed + run.failed:
+                self.write(result, seconds)
+
+    def begin(self):
+        pass
+
+    def write(self, result, seconds):
+        raise NotImplementedError
+
+    def end(self, totals):
+        pass
+
+    def close(self, totals):
+        with self.lock:
+            self.end(totals)
+            if self.owned:
+                self.out.close()
+            else:
+                self.out.flush()
+
+
+class _JsonLinesWriter(_Writer):
+    '''
+    one json object of _Writer.fields per line
+    '''
+
+    def write(self, result, seconds):
+        self.out.write(json.dumps(self.fields(result, seconds), default=str))
+        self.out.write('\n')
+
+
+class _JUnitWriter(_Writer):
+    '''
+    junit xml, a testcase per result in a single infratest testsuite
+
+    the testsuite is written before the totals are known, they follow the
+    testcases in system-out
+    '''
+
+    def begin(self):
+        # xml.sax.saxutils pulls in urllib and http.client, only the runs
+        # that write junit pay for it
+        from xml.sax.saxutils import escape, quoteattr
+        self.escape = escape
+        self.quoteattr = quoteattr
+        self.out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<testsuites>\n<testsuite name="infratest">\n')
+
+    def write(self, result, seconds):
+        escape, quoteattr = self.escape, self.quoteattr
+        fields = self.fields(result, seconds)
+        name = fields['attribute']
+        if fields['target'] is not None:
+            # systeminfo checks have no target
+            name = '{0} {1}'.format(fields['target'], name)
+        self.out.write('<testcase classname={0} name={1} time="{2:f}">'.format(
+            quoteattr('infratest.' + fields['kind']), quoteattr(name.strip()),
+            fields['duration']))
+        if not result.ok:
+            self.out.write('<failure message={0}>expected: {1}, found: {2}'
+                           '</failure>'.format(
+                               quoteattr(result.message()),
+                               escape(str(fields['expected'])),
+                               escape(str(fields['found']))))
+        self.out.write('</testcase>\n')
+
+    def end(self, totals):
+        summary = ', '.join('{0}: {1}'.format(key, totals[key])
+                            for key in sorted(totals))
+        self.out.write('<system-out>{0}</system-out>\n'
+                       '</testsuite>\n</testsuites>\n'.format(
+                           self.escape(summary)))
+
+
+_WRITERS = {
+    'jsonl': _JsonLinesWriter,
+    'junit': _JUnitWriter,
+}
+
+
+class _Listeners(object):
+    '''
+    hands every finished check to each of listeners, then drops the check's
+    results unless keep, the run only needs their counts
+    '''
+
+    def __init__(self, listeners, keep):
+        self.listeners = listeners
+        self.keep = keep
+
+    def __call__(self, check, run, seconds):
+        for listener in self.listeners:
+            listener(check, run, seconds)
+        if not self.keep:
+            del run.passed[:]
+            del run.failed[:]
+
+
+def _pillar():
+    try:
+        return __salt__['pillar.get']('infratest')
+    except NameError:
+        return None
+
+
+def plan():
+    '''
+    show the checks run_all would run for the infratest pillar
+
+    CLI Example::
+
+        salt '*' infratest.plan
+    '''
+    tests = _pillar()
+    if tests is None:
+        return (False, 'could not get infratest pillar data')
+    return [{'kind': check.kind, 'target': check.target,
+             'expected': check.expected} for check in _plan(tests)]
+
+
+def run_all(details=False, workers=1, incremental=False, stream=False,
+            profile=False, timeout=None, budget=None, output=None,
+            output_format=None):
+    '''
+    run every test configured in the infratest pillar
+
+    workers sets how many checks may run at once. most checks wait on
+    subprocesses (systemctl, dpkg-query, ss), so a handful of workers can
+    shorten runs over large pillars considerably.
+
+    incremental=True only runs checks whose inputs (file stat, package
+    database, account database or unit file timestamps) changed since the
+    last incremental run and reports the stored results of the others.
+    checks of running state (services, processes, sockets, mounts, ...) run
+    every time.
 
-    INFRATEST['Totals'] = {}
-    INFRATEST['Totals']['Pass'] = 0
-    INFRATEST['Totals']['Fail'] = 0
+    stream=True also sends results to the event bus as checks finish,
+    batched by infratest:event_batch_size results or
+    infratest:event_batch_seconds, followed by the totals.
 
-    for result in INFRATEST['Passed']:
-        INFRATEST['Totals']['Pass'] += 1
+    profile=True adds a Profile key with the wall time, subprocesses and
+    bytes read of the run's checks, per check category and for the
+    infratest:profile_top (10) slowest checks.
+
+    timeout (infratest:check_timeout) limits how many seconds a single check
+    may take and budget (infratest:run_budget) the whole run. checks run
+    into either are recorded as failed and the results gathered so far are
+    returned, instead of a hung stat or systemctl stalling the whole job.
+
+    output writes every result to a file as checks finish, as json lines or,
+    with output_format=junit or an output ending in .xml, junit xml. each
+    result has its kind, target, attribute, expected and found values,
+    duration and status.
+
+    CLI Example::
+
+        salt '*' infratest.run_all details=True workers=8
+        salt '*' infratest.run_all incremental=True
+        salt '*' infratest.run_all stream=True workers=8
+        salt '*' infratest.run_all profile=True
+        salt '*' infratest.run_all timeout=30 budget=240
+        salt '*' infratest.run_all output=/var/log/infratest.jsonl
+        salt '*' infratest.run_all output=/tmp/infratest.xml
+    '''
+    tests = _pillar()
+    if tests is None:
+        return (False, 'could not get infratest pillar data')
 
-    for result in INFRATEST['Failed']:
-        INFRATEST['Totals']['Fail'] += 1
+    if output_format is None:
+        output_format = 'junit' if str(output).endswith('.xml') else 'jsonl'
+    if output is not None and output_format not in _WRITERS:
+        return (False, 'unknown output_format {0}, use one of {1}'.format(
+            output_format, ', '.join(sorted(_WRITERS))))
+    writer = None
+    if output is not None:
+        # opened before anything runs, a bad path fails the call right away
+        try:
+            writer = _WRITERS[output_format](output)
+        except EnvironmentError as exc:
+            return (False, 'could not open output {0}: {1}'.format(
+                output, exc))
+
+    run = _Run(profile=_Profile() if profile else None,
+               keep=details or incremental or stream or output is not None,
+               batch=True)
+    if timeout is None:
+        timeout = _config('check_timeout', None)
+    if budget is None:
+        budget = _config('run_budget', None)
+    deadlines = None
+    if timeout is not None or budget is not None:
+        deadlines = _Deadlines(None if timeout is None else float(timeout),
+                               None if budget is None else float(budget))
+    plan = _expand(run, _plan(tests), workers, deadlines)
+    _prepare(run, plan)
+    cache = _result_cache() if incremental else None
+    events = _event_batcher(len(plan)) if stream else None
+    listeners = [listener.add for listener in (events, writer)
+                 if listener is not None]
+    done = _Listeners(listeners, details or incremental) if listeners else None
+    if cache is not None:
+        reused = _execute_incremental(run, plan, workers, cache, done,
+                                      deadlines)
+    else:
+        _execute(run, plan, workers, done, deadlines)
+    if run.facts.digest_cache is not None:
+        run.facts.digest_cache.save()
+
+    totals = run.totals()
+    if cache is not None:
+        totals['Reused'] = reused
+    if deadlines is not None:
+        totals['TimedOut'] = deadlines.missed
+    if events is not None:
+        events.close(totals)
+    if writer is not None:
+        writer.close(totals)
 
     if details:
-        return INFRATEST
+        result = run.details()
+        result['Totals'] = totals
     else:
-        return INFRATEST['Totals']
+        result = totals
+    if run.profile is not None:
+        result['Profile'] = run.profile.report(int(_config('profile_top', 10)))
+    return result
+
+
+# baseline files: a header, the root the paths are relative to, fixed size
+# records sorted by path and the utf-8 paths they point into
+_BASELINE_MAGIC = b'ITBL'
+_BASELINE_VERSION = 1
+_BASELINE_HEADER = struct.Struct('<4sIII')
+# path offset, path length, mode, uid, gid, size, mtime_ns, ctime_ns, inode,
+# sha256 (of the link target for symlinks, zeros for other non-files)
+_BASELINE_RECORD = struct.Struct('<QIIIIQqqQ32s')
+_NO_DIGEST = b'\0' * 32
+
+_BaselineEntry = collections.namedtuple(
+    '_BaselineEntry', 'path mode uid gid size mtime_ns ctime_ns ino digest')
+
+
+class _Baseline(object):
+    '''
+    a baseline file, memory-mapped and read one record at a time
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as handle:
+            self.map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.count, root_size = \
+                _BASELINE_HEADER.unpack_from(self.map)
+            if magic != _BASELINE_MAGIC or version != _BASELINE_VERSION:
+                raise ValueError(
+                    '{0} is not an infratest baseline'.format(path))
+            offset = _BASELINE_HEADER.size
+            self.root = os.fsdecode(self.map[offset:offset + root_size])
+            self.records = offset + root_size
+            self.paths = self.records + self.count * _BASELINE_RECORD.size
+        except (struct.error, ValueError):
+            self.map.close()
+            raise ValueError('{0} is not an infratest baseline'.format(path))
+
+    def __iter__(self):
+        for index in range(self.count):
+            fields = _BASELINE_RECORD.unpack_from(
+                self.map, self.records + index * _BASELINE_RECORD.size)
+            start = self.paths + fields[0]
+            path = os.fsdecode(self.map[start:start + fields[1]])
+            yield _BaselineEntry(path, *fields[2:])
+
+    def close(self):
+        self.map.close()
+
+
+def _baseline_path(root):
+    '''
+    return where the baseline of root is kept by default, under
+    infratest:baseline_dir (infratest/baselines in the minion cachedir)
+    '''
+    try:
+        default = os.path.join(__opts__['cachedir'], 'infratest', 'baselines')
+    except (NameError, KeyError):
+        default = os.path.join(tempfile.gettempdir(), 'infratest-baselines')
+    name = root.strip('/').replace('/', '_') or 'root'
+    digest = hashlib.sha1(os.fsencode(root)).hexdigest()[:8]
+    return os.path.join(_config('baseline_dir', default),
+                        '{0}-{1}.bin'.format(name, digest))
+
+
+def _baseline_tree(root, depth):
+    '''
+    return sorted (relative path, lstat) pairs of everything below root
+
+    root is walked as is, like the base of a glob, so that wildcards in its
+    name are not taken as a pattern
+    '''
+    prefix = root.rstrip('/')
+    matches = {}
+    if _glob_walk(root, prefix, ['**'], depth, matches):
+        LOG.warning('infratest: %s only searched %d directories deep, see '
+                    'infratest:glob_depth', root, depth)
+    return sorted((path[len(prefix) + 1:], lstat)
+                  for path, lstat in matches.items())
+
+
+def _baseline_digest(path, lstat):
+    '''
+    return the sha256 of a file, of the target of a symlink, or no digest
+    '''
+    if stat.S_ISREG(lstat.st_mode):
+        digests = _digests(path, ['sha256'])
+        if digests is None:
+            return _NO_DIGEST
+        return binascii.unhexlify(digests['sha256'])
+    if stat.S_ISLNK(lstat.st_mode):
+        try:
+            return hashlib.sha256(os.fsencode(os.readlink(path))).digest()
+        except OSError:
+            return _NO_DIGEST
+    return _NO_DIGEST
+
+
+def _baseline_changed(entry, lstat):
+    '''
+    return whether lstat differs from the baseline entry in a way that makes
+    the content suspect. ctime is included, unlike mtime it can not be set
+    back by hand.
+    '''
+    return (entry.ino, entry.size, entry.mtime_ns, entry.ctime_ns) != (
+        lstat.st_ino, lstat.st_size, lstat.st_mtime_ns, lstat.st_ctime_ns)
+
+
+def _write_baseline(path, root, entries):
+    '''
+    atomically write entries, (relative path, lstat, digest) sorted by path,
+    as the baseline of root to path
+    '''
+    encoded_root = os.fsencode(root)
+    records = []
+    paths = []
+    offset = 0
+    for name, lstat, digest in entries:
+        encoded = os.fsencode(name)
+        records.append(_BASELINE_RECORD.pack(
+            offset, len(encoded), lstat.st_mode, lstat.st_uid, lstat.st_gid,
+            lstat.st_size, lstat.st_mtime_ns, lstat.st_ctime_ns, lstat.st_ino,
+            digest))
+        paths.append(encoded)
+        offset += len(encoded)
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    handle, temp = tempfile.mkstemp(dir=directory or '.', prefix='.infratest.')
+    try:
+        with os.fdopen(handle, 'wb') as out:
+            out.write(_BASELINE_HEADER.pack(_BASELINE_MAGIC, _BASELINE_VERSION,
+                                            len(records), len(encoded_root)))
+            out.write(encoded_root)
+            out.write(b''.join(records))
+            out.write(b''.join(paths))
+        os.rename(temp, path)
+    except EnvironmentError:
+        os.remove(temp)
+        raise
+
+
+def baseline_capture(path, baseline=None, depth=None):
+    '''
+    record the metadata and sha256 of everything below path, for
+    baseline_compare
+
+    the baseline is kept under infratest:baseline_dir unless a file is given.
+    depth limits how many directories deep the tree is walked, it defaults
+    to infratest:glob_depth (16).
+
+    CLI Example::
+
+        salt '*' infratest.baseline_capture /usr/bin
+        salt '*' infratest.baseline_capture /etc baseline=/root/etc.bin
+    '''
+    root = os.path.abspath(path)
+    if not os.path.isdir(root):
+        return (False, '{0} is not a directory'.format(root))
+    if baseline is None:
+        baseline = _baseline_path(root)
+    if depth is None:
+        depth = _config('glob_depth', 16)
+    entries = [(name, lstat, _baseline_digest(os.path.join(root, name), lstat))
+               for name, lstat in _baseline_tree(root, int(depth))]
+    try:
+        _write_baseline(baseline, root, entries)
+    except EnvironmentError as exc:
+        return (False, 'could not write baseline {0}: {1}'.format(
+            baseline, exc))
+    return {'Baseline': baseline, 'Files': len(entries)}
+
+
+def baseline_compare(path, baseline=None, details=False, depth=None):
+    '''
+    compare the tree below path to its baseline_capture
+
+    the current tree and the baseline are walked side by side in path order.
+    only files whose inode, size, mtime or ctime changed are read again.
+    unchanged paths pass, added, removed and modified ones fail.
+
+    CLI Example::
+
+        salt '*' infratest.baseline_compare /usr/bin details=True
+        salt '*' infratest.baseline_compare /etc baseline=/root/etc.bin
+    '''
+    root = os.path.abspath(path)
+    if baseline is None:
+        baseline = _baseline_path(root)
+    if depth is None:
+        depth = _config('glob_depth', 16)
+    try:
+        recorded = _Baseline(baseline)
+    except (EnvironmentError, ValueError) as exc:
+        return (False, 'could not read baseline {0}: {1}'.format(
+            baseline, exc))
+    if recorded.root != root:
+        recorded.close()
+        return (False, 'baseline {0} was captured for {1}, not {2}'.format(
+            baseline, recorded.root, root))
+
+    run = _Run(keep=details)
+    counts = {'Added': 0, 'Removed': 0, 'Modified': 0}
+
+    def added(name):
+        counts['Added'] += 1
+        run.record('baseline_added', os.path.join(root, name), None, False)
+
+    def removed(entry):
+        counts['Removed'] += 1
+        run.record('baseline_removed', os.path.join(root, entry.path), None,
+                   False)
+
+    try:
+        current = iter(_baseline_tree(root, int(depth)))
+        here = next(current, None)
+        for entry in recorded:
+            while here is not None and here[0] < entry.path:
+                added(here[0])
+                here = next(current, None)
+            if here is None or here[0] != entry.path:
+                removed(entry)
+                continue
+            name, lstat = here
+            here = next(current, None)
+            full = os.path.join(root, name)
+            changes = []
+            if stat.S_IFMT(lstat.st_mode) != stat.S_IFMT(entry.mode):
+                changes.append('type')
+            if stat.S_IMODE(lstat.st_mode) != stat.S_IMODE(entry.mode):
+                changes.append('mode')
+            if (lstat.st_uid, lstat.st_gid) != (entry.uid, entry.gid):
+                changes.append('owner')
+            if ('type' not in changes and _baseline_changed(entry, lstat) and
+                    _baseline_digest(full, lstat) != entry.digest):
+                changes.append('content')
+            if changes:
+                counts['Modified'] += 1
+                run.record('baseline_modified', full, None, False, changes)
+            else:
+                run.record('baseline_unchanged', full, None, True)
+        while here is not None:
+            added(here[0])
+            here = next(current, None)
+    finally:
+        recorded.close()
+
+    totals = run.totals()
+    totals.update(counts)
+    if details:
+        report = run.details()
+        report['Totals'] = totals
+        return report
+    return totals
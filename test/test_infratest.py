@@ -1,6 +1,24 @@
+import hashlib
 import infratest
+import inspect
+import io
+import json
 import nose
 import os
+import pwd
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import xml.etree.ElementTree
+
+try:
+    from importlib import reload as reload_module
+except ImportError:
+    reload_module = reload
 
 def _standup_file_exists(path):
     if not os.path.isfile(path):
@@ -16,3 +34,921 @@ def test_file_exists():
     result_dict = infratest.file_exists(test_file_path, True)
     nose.tools.eq_(len(result_dict['Passed']), 1, msg=result_dict)
     _cleanup_file_exists(test_file_path)
+
+def test_cli_signatures():
+    for kind in infratest._CHECKS:
+        check = getattr(infratest, kind, None)
+        if check is None:
+            continue
+        nose.tools.ok_('run' not in inspect.signature(check).parameters, msg=kind)
+    result_dict = infratest.process_count('no-such-process', 'root', 0)
+    nose.tools.eq_(result_dict, {'Passed': ['no-such-process has 0 processes running owned by root'],
+                                 'Failed': []})
+
+def test_import_does_not_connect():
+    reload_module(infratest)
+    nose.tools.eq_(infratest._HOST, None)
+    infratest._host()
+    nose.tools.ok_(infratest._HOST is not None)
+
+def test_run_all_does_not_accumulate():
+    test_file_path = "./test/file_exists"
+    _standup_file_exists(test_file_path)
+    infratest.__salt__ = {
+        'pillar.get': lambda key: {'file': {test_file_path: {'exists': True}}}
+    }
+    try:
+        first = infratest.run_all()
+        tracemalloc.start()
+        for _ in range(500):
+            infratest.run_all()
+        grown = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        last = infratest.run_all(details=True)
+    finally:
+        del infratest.__salt__
+        _cleanup_file_exists(test_file_path)
+    nose.tools.eq_(first, {'Pass': 1, 'Fail': 0})
+    nose.tools.eq_(last['Totals'], first)
+    nose.tools.eq_(len(last['Passed']), 1, msg=last)
+    nose.tools.ok_(grown < 64 * 1024, msg=grown)
+
+def test_file_facts():
+    test_file_path = "./test/file_facts"
+    test_link_path = "./test/file_facts_link"
+    _standup_file_exists(test_file_path)
+    os.chmod(test_file_path, 0o640)
+    os.symlink(os.path.abspath(test_file_path), test_link_path)
+    run = infratest._Run()
+    try:
+        user = pwd.getpwuid(os.getuid()).pw_name
+        infratest._file_exists(run, test_file_path, True)
+        infratest._file_isfile(run, test_file_path, 'file')
+        infratest._file_user(run, test_file_path, user)
+        infratest._file_uid(run, test_file_path, os.getuid())
+        infratest._file_mode(run, test_file_path, '0640')
+        infratest._file_size(run, test_file_path, 16)
+        infratest._file_issymlink(run, test_link_path, 'symlink')
+        infratest._file_linkedto(run, test_link_path, os.path.abspath(test_file_path))
+        infratest._file_isfile(run, test_link_path, 'file')
+        infratest._file_exists(run, './test/file_missing', False)
+        infratest._file_mode(run, './test/file_missing', '0640')
+    finally:
+        os.remove(test_link_path)
+        _cleanup_file_exists(test_file_path)
+    report = run.report()
+    nose.tools.eq_(len(report['Passed']), 10, msg=report)
+    nose.tools.eq_(report['Failed'], ['./test/file_missing has mode: 0640, found: None'])
+    nose.tools.eq_(len(run.facts.files), 3)
+
+def _run_all(pillar, **kwargs):
+    infratest.__salt__ = {'pillar.get': lambda key: pillar}
+    try:
+        return infratest.run_all(**kwargs)
+    finally:
+        del infratest.__salt__
+
+def test_run_all_workers_keep_order():
+    pillar = {'file': {}}
+    for name in range(20):
+        pillar['file']['./test/missing{0}'.format(name)] = {
+            'exists': name % 3 == 0, 'type': 'file', 'mode': '0644'}
+    serial = _run_all(pillar, details=True)
+    parallel = _run_all(pillar, details=True, workers=4)
+    nose.tools.eq_(parallel, serial)
+    nose.tools.eq_(serial['Totals'], {'Pass': 13, 'Fail': 47})
+
+def test_file_contains_patterns():
+    test_file_path = "./test/file_contains"
+    with open(test_file_path, 'w') as f:
+        f.write('root:x:0:0:root:/root:/bin/bash\n'
+                'PermitRootLogin no\n'
+                'PermitRootLogin\nyes\n'
+                'call(arg) 1+1')
+    patterns = ['root', 'oot:x', '^PermitRootLogin no$', 'call(arg)',
+                '1+1$', '\\(arg\\)', '[[:digit:]]:[0-9]', '\\<Login', 'missing',
+                '^root.*bash$', 'PermitRootLogin[[:space:]]*yes',
+                'Login[^a-z]yes', 'Login\\syes']
+    try:
+        result = infratest.file_contains(test_file_path, patterns)
+        empty = infratest.file_contains('./test/file_missing', 'root')
+    finally:
+        _cleanup_file_exists(test_file_path)
+    nose.tools.eq_(result['Failed'],
+                   ['./test/file_contains contains: \\<Login',
+                    './test/file_contains contains: missing',
+                    './test/file_contains contains: PermitRootLogin[[:space:]]*yes',
+                    './test/file_contains contains: Login[^a-z]yes',
+                    './test/file_contains contains: Login\\syes'])
+    nose.tools.eq_(len(result['Passed']), 8)
+    nose.tools.eq_(len(empty['Failed']), 1)
+
+def test_file_contains_long_line():
+    test_file_path = "./test/file_contains"
+    with open(test_file_path, 'w') as f:
+        f.write('x' * 100 + 'needle' + 'y' * 100 + 'tail\nend\n')
+    chunk_size, overlap = infratest._CHUNK_SIZE, infratest._LINE_OVERLAP
+    infratest._CHUNK_SIZE, infratest._LINE_OVERLAP = 16, 8
+    try:
+        found = infratest._contains(test_file_path, [
+            'needle', 'tail$', '^xxx', '^y', 'needle$', 'xneedley', '^end$'])
+    finally:
+        infratest._CHUNK_SIZE, infratest._LINE_OVERLAP = chunk_size, overlap
+        _cleanup_file_exists(test_file_path)
+    nose.tools.eq_(found, set(['needle', 'tail$', '^xxx', 'xneedley',
+                               '^end$']))
+
+def test_file_digests_single_read():
+    test_file_path = "./test/file_digests"
+    _standup_file_exists(test_file_path)
+    reads = []
+    digests = infratest._digests
+
+    def counting_digests(path, algorithms):
+        reads.append(sorted(algorithms))
+        return digests(path, algorithms)
+
+    infratest._digests = counting_digests
+    try:
+        result = _run_all({'file': {test_file_path: {
+            'md5sum': hashlib.md5(b'file exists test').hexdigest(),
+            'sha256sum': hashlib.sha256(b'file exists test').hexdigest()}}},
+            details=True)
+        missing = infratest.file_md5sum('./test/file_missing', 'abc')
+    finally:
+        infratest._digests = digests
+        _cleanup_file_exists(test_file_path)
+    nose.tools.eq_(result['Totals'], {'Pass': 2, 'Fail': 0}, msg=result)
+    nose.tools.eq_(reads, [['md5', 'sha256'], ['md5']])
+    nose.tools.eq_(missing['Failed'], ['./test/file_missing has md5sum: abc, found: None'])
+
+def test_digest_cache():
+    cachedir = tempfile.mkdtemp()
+    test_file_path = "./test/file_digest_cache"
+    _standup_file_exists(test_file_path)
+    os.utime(test_file_path, (0, 0))
+    pillar = {'file': {test_file_path: {
+        'sha256sum': hashlib.sha256(b'file exists test').hexdigest()}}}
+    reads = []
+    digests = infratest._digests
+
+    def counting_digests(path, algorithms):
+        reads.append(path)
+        return digests(path, algorithms)
+
+    infratest._digests = counting_digests
+    infratest.__opts__ = {'cachedir': cachedir}
+    try:
+        cold = _run_all(pillar)
+        warm = _run_all(pillar)
+        # same size and mtime, only the ctime tells
+        with open(test_file_path, 'w') as f:
+            f.write('file exists TEST')
+        os.utime(test_file_path, (0, 0))
+        rewritten = _run_all(pillar)
+        with open(test_file_path, 'a') as f:
+            f.write('!')
+        os.utime(test_file_path, (0, 0))
+        changed = _run_all(pillar)
+    finally:
+        infratest._digests = digests
+        del infratest.__opts__
+        _cleanup_file_exists(test_file_path)
+        shutil.rmtree(cachedir)
+    nose.tools.eq_(cold, {'Pass': 1, 'Fail': 0})
+    nose.tools.eq_(warm, cold)
+    nose.tools.eq_(rewritten, {'Pass': 0, 'Fail': 1})
+    nose.tools.eq_(changed, {'Pass': 0, 'Fail': 1})
+    nose.tools.eq_(reads, [test_file_path] * 3)
+
+def test_package_inventory():
+    commands = []
+
+    def dpkg_query(*args):
+        commands.append(args[0])
+        return ('exim4\tall\tinstall ok installed\t4.84-8\n'
+                'libc6\tamd64\tinstall ok installed\t2.19-18\n'
+                'libc6\ti386\tdeinstall ok config-files\t2.31-13\n'
+                'nginx\tall\tdeinstall ok config-files\t1.6.2-5\n')
+
+    command = infratest._command
+    infratest._command = dpkg_query
+    try:
+        result = _run_all({'package': {
+            'exim4': {'installed': True, 'version': 4.84},
+            'libc6:amd64': {'installed': True, 'version': '2.19'},
+            'libc6': {'installed': True, 'version': '2.19'},
+            'libc6:i386': {'installed': False},
+            'nginx': {'installed': False, 'version': '1.6'},
+            'postfix': {'installed': True}}}, details=True)
+    finally:
+        infratest._command = command
+    nose.tools.eq_(commands, ['dpkg-query'])
+    # removed packages keep their config files but have no version
+    nose.tools.eq_(result['Failed'], ['nginx is version: 1.6, found: None',
+                                      'postfix is installed: True'])
+    nose.tools.eq_(result['Totals'], {'Pass': 8, 'Fail': 2})
+
+def _replay(*args):
+    # replay command output captured in test/fixtures
+    name = '-'.join(arg for arg in args[:3] if not arg.startswith('-'))
+    path = os.path.join(os.path.dirname(__file__), 'fixtures', name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+def test_service_index():
+    commands = []
+
+    def replay(*args, **kwargs):
+        commands.append(' '.join(args[:3]))
+        return _replay(*args)
+
+    command = infratest._command
+    infratest._command = replay
+    try:
+        result = _run_all({'service': {
+            'cron': {'running': True, 'enabled': True, 'valid': True},
+            'exim4.service': {'running': True, 'enabled': True},
+            'rsync': {'running': False, 'enabled': False},
+            'systemd-journald': {'enabled': True},
+            'sshd': {'running': True, 'enabled': True},
+            'getty@tty1': {'running': True, 'enabled': True},
+            'nginx': {'running': True, 'valid': True}}}, details=True)
+    finally:
+        infratest._command = command
+    nose.tools.eq_(result['Failed'], ['nginx is running: True',
+                                      'nginx is valid: True'])
+    nose.tools.eq_(result['Totals'], {'Pass': 12, 'Fail': 2})
+    nose.tools.eq_(sorted(commands), [
+        'systemctl list-unit-files --type=service',
+        'systemctl list-units --all',
+        'systemctl show getty@tty1.service',
+        'systemctl show nginx.service',
+        'systemctl show sshd.service',
+        'systemd-analyze verify cron.service',
+        'systemd-analyze verify nginx.service'])
+
+def test_socket_table():
+    proc = infratest._PROC
+    infratest._PROC = os.path.join(os.path.dirname(__file__), 'fixtures', 'proc')
+    try:
+        result = _run_all({'socket': {
+            'tcp://22': {'listening': True},
+            'tcp://0.0.0.0:22': {'listening': True},
+            'tcp://10.0.2.15:22': {'listening': True},
+            'tcp://127.0.0.1:25': {'listening': True},
+            'tcp://25': {'listening': False},
+            'tcp://::1:80': {'listening': True},
+            'tcp://0:0:0:0:0:0:0:1:80': {'listening': True},
+            'tcp://127.0.0.1:80': {'listening': False},
+            'udp://68': {'listening': False},
+            'udp://0.0.0.0:68': {'listening': True},
+            'udp://127.0.0.53:53': {'listening': True},
+            'udp://10.0.2.15:41394': {'listening': False},
+            'unix:///run/dbus/system_bus_socket': {'listening': True},
+            'unix:///run/systemd/notify': {'listening': True},
+            'unix:///run/missing.sock': {'listening': False}}}, details=True)
+    finally:
+        infratest._PROC = proc
+    nose.tools.eq_(result['Failed'], [])
+    nose.tools.eq_(result['Totals'], {'Pass': 15, 'Fail': 0})
+
+def test_process_table():
+    proc = infratest._PROC
+    infratest._PROC = os.path.join(os.path.dirname(__file__), 'fixtures', 'proc')
+    try:
+        result = _run_all({'process': {
+            'sshd': {'root': {'count': 2}, 4242: {'count': 1}},
+            'systemd': {'root': {'count': 1}},
+            '^php-fpm': {4242: {'count': 2, 'match': 'regex', 'cmdline': 'pool www'},
+                         'root': {'count': 1, 'match': 'regex'}},
+            'php-fpm': {'root': {'count': 1}},
+            'kworker': {'root': {'count': 1}}}}, details=True)
+    finally:
+        infratest._PROC = proc
+    nose.tools.eq_(result['Failed'], [
+        'php-fpm has 1 processes running owned by root, found: 0',
+        'kworker has 1 processes running owned by root, found: 0'])
+    nose.tools.eq_(result['Totals'], {'Pass': 5, 'Fail': 2})
+
+def test_account_index():
+    root = pwd.getpwnam('root')
+    gids = subprocess.check_output(['id', '-G', 'root']).decode().split()
+    groups = subprocess.check_output(['id', '-nG', 'root']).decode().split()
+    result = _run_all({
+        'user': {
+            'root': {'exists': True, 'uid': 0, 'gid': 0, 'group': 'root',
+                     'gids': ','.join(gids), 'groups': ','.join(groups),
+                     'home': root.pw_dir, 'shell': root.pw_shell},
+            'no-such-user': {'exists': False, 'uid': 0}},
+        'group': {
+            'root': {'exists': True, 'gid': 0},
+            'no-such-group': {'exists': False}}}, details=True)
+    nose.tools.eq_(result['Failed'], ['no-such-user has uid: 0, found: None'])
+    nose.tools.eq_(result['Totals'], {'Pass': 12, 'Fail': 1})
+
+def test_mount_table():
+    proc = infratest._PROC
+    infratest._PROC = os.path.join(os.path.dirname(__file__), 'fixtures', 'proc')
+    try:
+        result = _run_all({'mount': {
+            '/': {'exists': True, 'device': '/dev/sda1', 'filesystem': 'ext4',
+                  'options': 'rw,data=ordered'},
+            '/data': {'device': '/dev/sdb', 'filesystem': 'ext4',
+                      'options': ['rw', 'noatime', 'data=writeback']},
+            '/srv/nfs': {'options': ['ro', 'noatime']},
+            '/mnt/my share': {'device': '//fileserver/my share', 'filesystem': 'cifs'},
+            '/var/lib/docker': {'filesystem': 'xfs', 'options': ['noquota']},
+            '/missing': {'exists': False, 'options': 'rw'}}}, details=True)
+    finally:
+        infratest._PROC = proc
+    nose.tools.eq_(result['Failed'], ['/missing has rw, found: None'])
+    nose.tools.eq_(result['Totals'], {'Pass': 13, 'Fail': 1})
+
+def test_sysctl_reader():
+    proc = infratest._PROC
+    infratest._PROC = os.path.join(os.path.dirname(__file__), 'fixtures', 'proc')
+    try:
+        result = _run_all({'sysctl': {
+            'kernel.ostype': {'value': 'Linux'},
+            'vm.dirty_ratio': {'value': 20},
+            'net/ipv4/ip_forward': {'value': 0},
+            'net.ipv4.ip_local_port_range': {'value': '32768\t60999'},
+            'net.ipv4.conf.eth0/100.rp_filter': {'value': 2},
+            'kernel.no_such_key': {'value': 1}}}, details=True)
+    finally:
+        infratest._PROC = proc
+    nose.tools.eq_(result['Failed'], ['net/ipv4/ip_forward: 0, found: 1',
+                                      'kernel.no_such_key is not a valid sysctl setting'])
+    nose.tools.eq_(result['Totals'], {'Pass': 4, 'Fail': 2})
+
+def test_interface_snapshot():
+    commands = []
+
+    def replay(*args):
+        commands.append(' '.join(args))
+        return _replay(*args)
+
+    command, sys_root = infratest._command, infratest._SYS
+    infratest._command = replay
+    infratest._SYS = os.path.join(os.path.dirname(__file__), 'fixtures', 'sys')
+    try:
+        result = _run_all({'interface': {
+            'eth0': {'exists': True, 'speed': 1000,
+                     'addresses': ['192.168.1.2', '192.168.1.3',
+                                   'fe80::5054:ff:fe12:3456']},
+            'eth0.100': {'exists': True, 'speed': None, 'addresses': '10.100.0.2'},
+            'br0': {'speed': 10000, 'addresses': ['10.0.0.1']},
+            'eth1': {'exists': False}}}, details=True)
+    finally:
+        infratest._command, infratest._SYS = command, sys_root
+    nose.tools.eq_(result['Failed'], ['br0 has address: 10.0.0.1, found: []'])
+    nose.tools.eq_(result['Totals'], {'Pass': 10, 'Fail': 1})
+    nose.tools.eq_(commands, ['ip -j addr show'])
+
+def test_plan():
+    pillar = {
+        'file': {'/etc/passwd': {'exists': True, 'type': 'fifo', 'mode': 644}},
+        'process': {'sshd': {'root': {'count': 1}}},
+        'systeminfo': {'release': '9', 'type': 'linux'},
+        'mount': {'/': {'options': 'rw,relatime'}}}
+    compiled = []
+    compile_plan = infratest._compile
+
+    def counting(tests):
+        compiled.append(tests)
+        return compile_plan(tests)
+
+    infratest._compile = counting
+    infratest.__salt__ = {'pillar.get': lambda key: pillar}
+    try:
+        first = infratest.plan()
+        second = infratest.plan()
+        pillar['file']['/etc/passwd']['mode'] = '0600'
+        changed = infratest.plan()
+    finally:
+        infratest._compile = compile_plan
+        del infratest.__salt__
+    nose.tools.eq_(first, [
+        {'kind': 'file_exists', 'target': '/etc/passwd', 'expected': True},
+        {'kind': 'file_badtype', 'target': '/etc/passwd', 'expected': 'fifo'},
+        {'kind': 'file_mode', 'target': '/etc/passwd', 'expected': '0644'},
+        {'kind': 'process_count', 'target': 'sshd', 'expected': 1},
+        {'kind': 'systeminfo_type', 'target': None, 'expected': 'linux'},
+        {'kind': 'systeminfo_release', 'target': None, 'expected': '9'},
+        {'kind': 'mount_options', 'target': '/',
+         'expected': ('rw', 'relatime')}])
+    nose.tools.eq_(second, first)
+    nose.tools.eq_(changed[2]['expected'], '0600')
+    nose.tools.eq_(len(compiled), 2)
+
+def test_incremental_inputs():
+    cachedir = tempfile.mkdtemp()
+    passwd = os.path.join(cachedir, 'passwd')
+    group = os.path.join(cachedir, 'group')
+    nsswitch = os.path.join(cachedir, 'nsswitch.conf')
+    with open(passwd, 'w') as f:
+        f.write('root:x:0:0:root:/root:/bin/bash\n')
+    with open(group, 'w') as f:
+        f.write('root:x:0:\n')
+    with open(nsswitch, 'w') as f:
+        f.write('passwd: files sss # remote accounts\ngroup: files [SUCCESS=merge] sss\n')
+
+    def inputs(kind, target, command=lambda *args: None):
+        infratest._command = command
+        return infratest._inputs(infratest._Check(kind, target, True, ()),
+                                 infratest._Facts())
+
+    saved = (infratest._ACCOUNT_DBS, infratest._NSSWITCH, infratest._command)
+    infratest._ACCOUNT_DBS = (passwd, group)
+    infratest._NSSWITCH = nsswitch
+    try:
+        remote = [inputs('user_exists', 'root'), inputs('user_exists', 'alice'),
+                  inputs('user_groups', 'root'), inputs('group_gid', 'root'),
+                  inputs('file_user', '/etc/hosts')]
+        infratest._NSSWITCH = os.path.join(cachedir, 'missing')
+        local = inputs('user_exists', 'alice')
+        sysv = inputs('service_isenabled', 'cron')
+        systemd = inputs('service_isenabled', 'cron', _replay)
+    finally:
+        (infratest._ACCOUNT_DBS, infratest._NSSWITCH,
+         infratest._command) = saved
+        shutil.rmtree(cachedir)
+    accounts = (passwd, group, nsswitch)
+    nose.tools.eq_(remote, [accounts, None, None, accounts, None])
+    nose.tools.eq_(local, (passwd, group, os.path.join(cachedir, 'missing')))
+    nose.tools.eq_(sysv, None)
+    nose.tools.ok_('/etc/systemd/system' in systemd)
+
+def test_run_all_incremental():
+    cachedir = tempfile.mkdtemp()
+    test_file_path = os.path.join(cachedir, 'file_incremental')
+    _standup_file_exists(test_file_path)
+    os.chmod(test_file_path, 0o644)
+    package_db = os.path.join(cachedir, 'status')
+    _standup_file_exists(package_db)
+    pillar = {
+        'file': {test_file_path: {'exists': True, 'mode': '0644'}},
+        'package': {'exim4': {'installed': True}},
+        'sysctl': {'vm.dirty_ratio': {'value': 20}}}
+    config = {'infratest:full_refresh': 3600}
+    dispatched = []
+    run_check = infratest._run_check
+
+    def counting_run_check(check, run):
+        dispatched[-1].append(check.kind)
+        run_check(check, run)
+
+    def run_all(**kwargs):
+        dispatched.append([])
+        result = infratest.run_all(incremental=True, **kwargs)
+        dispatched[-1].sort()
+        return result
+
+    saved = (infratest._run_check, infratest._command, infratest._PROC,
+             infratest._PACKAGE_DBS, infratest._RACY_SECONDS)
+    infratest._run_check = counting_run_check
+    infratest._command = lambda *args: 'exim4\tall\tinstall ok installed\t4.84-8\n'
+    infratest._PROC = os.path.join(os.path.dirname(__file__), 'fixtures', 'proc')
+    infratest._PACKAGE_DBS = (package_db,)
+    infratest._RACY_SECONDS = 0
+    infratest.__opts__ = {'cachedir': cachedir}
+    infratest.__salt__ = {'pillar.get': lambda key: pillar,
+                          'config.get': lambda key, default: config.get(key, default)}
+    try:
+        cold = run_all()
+        warm = run_all()
+        os.chmod(test_file_path, 0o600)
+        changed = run_all(details=True)
+        config['infratest:full_refresh'] = 0
+        refreshed = run_all()
+    finally:
+        (infratest._run_check, infratest._command, infratest._PROC,
+         infratest._PACKAGE_DBS, infratest._RACY_SECONDS) = saved
+        del infratest.__opts__
+        del infratest.__salt__
+        shutil.rmtree(cachedir)
+    nose.tools.eq_(cold, {'Pass': 4, 'Fail': 0, 'Reused': 0})
+    nose.tools.eq_(warm, {'Pass': 4, 'Fail': 0, 'Reused': 3})
+    nose.tools.eq_(changed['Totals'], {'Pass': 3, 'Fail': 1, 'Reused': 1})
+    nose.tools.eq_(changed['Failed'][0],
+                   test_file_path + ' has mode: 0644, found: 0600')
+    nose.tools.eq_(refreshed, {'Pass': 3, 'Fail': 1, 'Reused': 0})
+    nose.tools.eq_(dispatched, [
+        ['file_exists', 'file_mode', 'package_isinstalled', 'sysctl'],
+        ['sysctl'],
+        ['file_exists', 'file_mode', 'sysctl'],
+        ['file_exists', 'file_mode', 'package_isinstalled', 'sysctl']])
+
+class _EventSink(object):
+    """
+    stands in for the salt event bus, keeping what was sent
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def send(self, tag, data=None):
+        self.events.append((tag, data))
+        return True
+
+def test_run_all_incremental_hung_stat():
+    cachedir = tempfile.mkdtemp()
+    hung_path = os.path.join(cachedir, 'on_dead_nfs')
+    release = threading.Event()
+    stat_key = infratest._stat_key
+
+    def hung_stat_key(path, started):
+        if path == hung_path:
+            release.wait()
+        return stat_key(path, started)
+
+    pillar = {'file': {hung_path: {'exists': False},
+                       cachedir: {'exists': True}}}
+    infratest._stat_key = hung_stat_key
+    infratest.__opts__ = {'cachedir': cachedir}
+    infratest.__salt__ = {'pillar.get': lambda key: pillar,
+                          'config.get': lambda key, default: default}
+    started = time.time()
+    try:
+        result = infratest.run_all(incremental=True, timeout=0.5,
+                                   details=True)
+        seconds = time.time() - started
+    finally:
+        release.set()
+        infratest._stat_key = stat_key
+        del infratest.__opts__
+        del infratest.__salt__
+        shutil.rmtree(cachedir)
+    nose.tools.ok_(seconds < 5, msg=seconds)
+    nose.tools.eq_(result['Totals'],
+                   {'Pass': 1, 'Fail': 1, 'Reused': 0, 'TimedOut': 1})
+    nose.tools.eq_(result['Failed'],
+                   [hung_path + ' file_exists timed out after 0.5 seconds'])
+
+def test_event_batch_seconds():
+    sink = _EventSink()
+    events = infratest._EventBatcher(sink.send, 'infratest/run_all', 2,
+                                     interval=0.1)
+    run = infratest._Run()
+    run.record('file_exists', './test/missing', True, False)
+    events.add(None, run, 0.0)
+    # the second check is still running when the first result is due
+    time.sleep(0.5)
+    sent = list(sink.events)
+    events.close({'Pass': 0, 'Fail': 1})
+    nose.tools.eq_([(tag, data['Done']) for tag, data in sent],
+                   [('infratest/run_all/results', 1)])
+    nose.tools.eq_(len(sink.events), 2)
+
+def test_run_all_stream():
+    pillar = {'file': {}}
+    for name in range(7):
+        pillar['file']['./test/missing{0}'.format(name)] = {'exists': name % 2 == 0}
+    sink = _EventSink()
+    config = {'infratest:event_batch_size': 3}
+    infratest.__salt__ = {'pillar.get': lambda key: pillar,
+                          'config.get': lambda key, default: config.get(key, default),
+                          'event.send': sink.send}
+    try:
+        serial = infratest.run_all(details=True, stream=True)
+        sent, sink.events = sink.events, []
+        parallel = infratest.run_all(details=True, stream=True, workers=4)
+    finally:
+        del infratest.__salt__
+    nose.tools.eq_(parallel, serial)
+    nose.tools.eq_([(tag, data['Done']) for tag, data in sent[:-1]], [
+        ('infratest/run_all/results', 3),
+        ('infratest/run_all/results', 6),
+        ('infratest/run_all/results', 7)])
+    nose.tools.eq_(sent[0][1]['Passed'], serial['Passed'][:1])
+    nose.tools.eq_(sent[-1], ('infratest/run_all/complete', {'Pass': 3, 'Fail': 4}))
+    for events in sent, sink.events:
+        nose.tools.eq_(sum(len(data['Passed']) + len(data['Failed'])
+                           for tag, data in events[:-1]), 7)
+        nose.tools.eq_(events[-1], sent[-1])
+
+def test_run_all_output():
+    pillar = {'file': {}}
+    for name in range(5):
+        pillar['file']['./test/missing{0}'.format(name)] = {'exists': name % 2 == 0}
+    pillar['sysctl'] = {'kernel.missing_key': {'value': '1'}}
+    directory = tempfile.mkdtemp()
+    try:
+        stream = io.StringIO()
+        nose.tools.eq_(_run_all(pillar, output=stream, workers=3),
+                       {'Pass': 2, 'Fail': 4})
+        path = os.path.join(directory, 'results.xml')
+        nose.tools.eq_(_run_all(pillar, output=path), {'Pass': 2, 'Fail': 4})
+        suite = xml.etree.ElementTree.parse(path).getroot().find('testsuite')
+        nose.tools.eq_(_run_all(pillar, output=path, output_format='yaml')[0], False)
+        unwritable = _run_all(pillar, output=os.path.join(directory, 'missing', 'results.jsonl'))
+        _run_all({'systeminfo': {'type': 'linux'}}, output=path)
+        info = xml.etree.ElementTree.parse(path).getroot().find('testsuite/testcase')
+    finally:
+        shutil.rmtree(directory)
+    records = sorted((json.loads(line) for line in stream.getvalue().splitlines()),
+                     key=lambda record: record['target'])
+    nose.tools.eq_(len(records), 6)
+    nose.tools.eq_(records[0]['target'], './test/missing0')
+    nose.tools.eq_(sorted(records[0]), ['attribute', 'duration', 'expected',
+                                        'found', 'kind', 'status', 'target'])
+    nose.tools.eq_((records[0]['kind'], records[0]['attribute'], records[0]['status']),
+                   ('file', 'exists', 'failed'))
+    nose.tools.eq_((records[1]['expected'], records[1]['status']), (False, 'passed'))
+    nose.tools.eq_((records[5]['kind'], records[5]['attribute']), ('sysctl', 'invalid'))
+    cases = suite.findall('testcase')
+    nose.tools.eq_(len(cases), 6)
+    nose.tools.eq_(cases[0].get('classname'), 'infratest.file')
+    nose.tools.eq_(cases[0].get('name'), './test/missing0 exists')
+    nose.tools.eq_(len(suite.findall('testcase/failure')), 4)
+    nose.tools.eq_(suite.find('system-out').text, 'Fail: 4, Pass: 2')
+    nose.tools.eq_(unwritable[0], False)
+    nose.tools.ok_(unwritable[1].startswith('could not open output'), msg=unwritable[1])
+    nose.tools.eq_((info.get('classname'), info.get('name')), ('infratest.systeminfo', 'type'))
+
+def test_run_all_profile():
+    test_file_path = "./test/file_profile"
+    _standup_file_exists(test_file_path)
+    pillar = {'file': {test_file_path: {
+        'exists': True, 'contains': ['exists', 'missing']}}}
+    try:
+        plain = _run_all(pillar)
+        profiled = _run_all(pillar, profile=True, workers=2)
+    finally:
+        _cleanup_file_exists(test_file_path)
+    nose.tools.eq_(plain, {'Pass': 2, 'Fail': 1})
+    profile = profiled.pop('Profile')
+    nose.tools.eq_(profiled, plain)
+    nose.tools.eq_(profile['Checks'], 2)
+    nose.tools.eq_(sorted(profile['Categories']), ['file'])
+    nose.tools.eq_(profile['Categories']['file']['bytes_read'], 16)
+    nose.tools.eq_(sorted((check['kind'], check['bytes_read'])
+                          for check in profile['Slowest']),
+                   [('file_contains', 16), ('file_exists', 0)])
+
+    def shell_check(run, thing, expected):
+        infratest._command(sys.executable, '-c', 'print("x" * 9)')
+
+    def testinfra_check(run, thing, expected):
+        infratest._host().run('true')
+
+    record = infratest._Profile()
+    check = infratest._Check('shell', None, None, (None, None))
+    record.measure(check, shell_check, infratest._Run())
+    nose.tools.eq_(record.report()['Slowest'][0]['commands'], 1)
+    record.measure(check._replace(kind='testinfra'), testinfra_check,
+                   infratest._Run())
+    nose.tools.eq_(record.report()['Categories']['testinfra']['commands'], 1)
+    nose.tools.eq_(record.report()['Categories']['shell']['bytes_read'], 10)
+
+    def mount_check(run, thing, expected):
+        infratest._mounts()
+
+    proc = infratest._PROC
+    infratest._PROC = os.path.join(os.path.dirname(__file__), 'fixtures', 'proc')
+    try:
+        record.measure(check._replace(kind='mount'), mount_check,
+                       infratest._Run())
+        mountinfo = os.path.join(infratest._PROC, 'self', 'mountinfo')
+    finally:
+        infratest._PROC = proc
+    nose.tools.eq_(record.report()['Categories']['mount']['bytes_read'],
+                   os.path.getsize(mountinfo))
+    nose.tools.ok_(infratest._PROFILING.record is None)
+
+def test_run_all_deadlines():
+    pillar = {'file': {}}
+    for name in range(3):
+        pillar['file']['./test/missing{0}'.format(name)] = {
+            'exists': False, 'mode': '0644'}
+    release = threading.Event()
+    file_mode = infratest._CHECKS['file_mode']
+
+    def hung_file_mode(run, thing, expected):
+        release.wait()
+        run.record('file_mode', thing, expected, True)
+
+    infratest._CHECKS['file_mode'] = hung_file_mode
+    try:
+        started = time.time()
+        timed = _run_all(pillar, details=True, workers=3, timeout=0.2)
+        budgeted = _run_all(pillar, details=True, budget=0.3)
+        elapsed = time.time() - started
+    finally:
+        infratest._CHECKS['file_mode'] = file_mode
+        release.set()
+    nose.tools.ok_(elapsed < 5, msg=elapsed)
+    nose.tools.eq_(timed['Totals'], {'Pass': 3, 'Fail': 3, 'TimedOut': 3})
+    nose.tools.eq_(timed['Failed'][0],
+                   './test/missing0 file_mode timed out after 0.2 seconds')
+    nose.tools.eq_(budgeted['Totals'], {'Pass': 1, 'Fail': 5, 'TimedOut': 5})
+    nose.tools.eq_(budgeted['Failed'][:2], [
+        './test/missing0 file_mode timed out, run budget used up',
+        './test/missing1 file_exists not run, run budget used up'])
+    nose.tools.ok_(not any('mode' in detail
+                           for detail in timed['Passed'] + budgeted['Passed']))
+
+    infratest._DEADLINE.at = time.time() + 0.2
+    try:
+        nose.tools.assert_raises(infratest._CommandTimeout, infratest._command,
+                                 sys.executable, '-c', 'import time; time.sleep(30)')
+    finally:
+        infratest._DEADLINE.at = None
+    nose.tools.ok_(time.time() - started < 10)
+
+def test_run_all_deadlines_killed_command():
+    hung = [sys.executable, '-c', 'import time; time.sleep(30)']
+    command = infratest._command
+
+    def hung_show(*args, **kwargs):
+        if args[:2] == ('systemctl', 'show'):
+            return command(*hung)
+        return _replay(*args)
+
+    infratest._command = hung_show
+    try:
+        result = _run_all({'service': {
+            'nginx': {'running': True, 'enabled': True},
+            'getty@tty1': {'enabled': True}}}, details=True, timeout=1)
+    finally:
+        infratest._command = command
+    # the killed systemctl show is neither a failure nor cached for the
+    # other nginx check
+    nose.tools.eq_(result['Totals'], {'Pass': 0, 'Fail': 3, 'TimedOut': 3})
+    nose.tools.eq_(result['Failed'], [
+        'nginx service_isrunning timed out after 1.0 seconds',
+        'nginx service_isenabled timed out after 1.0 seconds',
+        'getty@tty1 service_isenabled timed out after 1.0 seconds'])
+
+def test_run_all_deadlines_late_results():
+    file_mode = infratest._CHECKS['file_mode']
+    file_exists = infratest._CHECKS['file_exists']
+    threads = set()
+
+    def slow_file_mode(run, thing, expected):
+        time.sleep(0.3)
+        file_mode(run, thing, expected)
+
+    def slow_file_exists(run, thing, expected):
+        time.sleep(0.15)
+        file_exists(run, thing, expected)
+
+    def counting_file_exists(run, thing, expected):
+        threads.add(threading.current_thread())
+        file_exists(run, thing, expected)
+
+    infratest._CHECKS['file_mode'] = slow_file_mode
+    infratest._CHECKS['file_exists'] = slow_file_exists
+    try:
+        # file_mode gives up at 0.2s and finishes at 0.3s, while file_exists
+        # is still running
+        late = _run_all({'file': {'./test/missing0': {'mode': '0644'},
+                                  './test/missing1': {'exists': False}}},
+                        details=True, timeout=0.2)
+        infratest._CHECKS['file_exists'] = counting_file_exists
+        pillar = {'file': dict(('./test/missing{0}'.format(name),
+                                {'exists': False}) for name in range(200))}
+        pooled = _run_all(pillar, workers=4, timeout=5)
+    finally:
+        infratest._CHECKS['file_mode'] = file_mode
+        infratest._CHECKS['file_exists'] = file_exists
+    nose.tools.eq_(late['Totals'], {'Pass': 1, 'Fail': 1, 'TimedOut': 1})
+    nose.tools.eq_(late['Failed'],
+                   ['./test/missing0 file_mode timed out after 0.2 seconds'])
+    nose.tools.eq_(pooled, {'Pass': 200, 'Fail': 0, 'TimedOut': 0})
+    # the checks share a pool of workers instead of a thread each
+    nose.tools.ok_(len(threads) <= 4, msg=len(threads))
+
+def test_file_globs():
+    root = tempfile.mkdtemp()
+    for path in ('ssh/ssh_host_rsa_key', 'ssh/ssh_host_ed25519_key',
+                 'ssh/ssh_host_rsa_key.pub', 'ssh/.hidden_key', 'cron.d/a',
+                 'cron.d/sub/b', 'cron.d/sub/deeper/c'):
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        _standup_file_exists(path)
+        os.chmod(path, 0o600)
+    os.chmod(os.path.join(root, 'ssh', 'ssh_host_rsa_key.pub'), 0o644)
+    pillar = {'file': {
+        root + '/ssh/*_key': {'type': 'file', 'mode': '0600'},
+        root + '/cron.d/**': {'exists': True},
+        root + '/cron.d/**/c': {'mode': '0600'},
+        root + '/ssh/*.bak': {'exists': False}}}
+    lstat = os.lstat
+    lstats = []
+
+    def counting_lstat(path):
+        lstats.append(path)
+        return lstat(path)
+
+    os.lstat = counting_lstat
+    try:
+        result = _run_all(pillar, details=True)
+        shallow = infratest._glob(root + '/cron.d/**', 0)
+    finally:
+        os.lstat = lstat
+        shutil.rmtree(root)
+    nose.tools.eq_(result['Failed'], [])
+    nose.tools.eq_(result['Passed'], [
+        root + '/ssh/.hidden_key is: file',
+        root + '/ssh/.hidden_key has mode: 0600',
+        root + '/ssh/ssh_host_ed25519_key is: file',
+        root + '/ssh/ssh_host_ed25519_key has mode: 0600',
+        root + '/ssh/ssh_host_rsa_key is: file',
+        root + '/ssh/ssh_host_rsa_key has mode: 0600',
+        root + '/cron.d/a exists: True',
+        root + '/cron.d/sub exists: True',
+        root + '/cron.d/sub/b exists: True',
+        root + '/cron.d/sub/deeper exists: True',
+        root + '/cron.d/sub/deeper/c exists: True',
+        root + '/cron.d/sub/deeper/c has mode: 0600',
+        root + '/ssh/*.bak exists: False'])
+    nose.tools.eq_(lstats, [root + '/ssh/*.bak'])
+    nose.tools.eq_([path for path, _ in shallow],
+                   [root + '/cron.d/a', root + '/cron.d/sub'])
+
+def test_file_glob_deadlines():
+    release = threading.Event()
+    glob = infratest._glob
+
+    def hung_glob(pattern, depth=16):
+        # a walk into a dead nfs mount
+        if pattern.startswith('./test/hung'):
+            release.wait()
+        return glob(pattern, depth)
+
+    infratest._glob = hung_glob
+    try:
+        started = time.time()
+        result = _run_all({'file': {'./test/hung/*': {'exists': True},
+                                    './test/missing0': {'exists': False}}},
+                          details=True, timeout=0.2)
+        elapsed = time.time() - started
+    finally:
+        infratest._glob = glob
+        release.set()
+    nose.tools.ok_(elapsed < 5, msg=elapsed)
+    nose.tools.eq_(result['Totals'], {'Pass': 1, 'Fail': 1, 'TimedOut': 1})
+    nose.tools.eq_(result['Failed'],
+                   ['./test/hung/* file_glob timed out after 0.2 seconds'])
+
+def test_baseline():
+    root = tempfile.mkdtemp()
+    # wildcards in the root are part of its name
+    tree = os.path.join(root, 'tree[1]')
+    for name in ('bin/a', 'bin/b', 'bin/c', 'etc/d', 'etc/e'):
+        path = os.path.join(tree, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(name)
+    os.symlink('a', os.path.join(tree, 'bin', 'link'))
+    baseline = os.path.join(root, 'tree.bin')
+    reads = []
+    digests = infratest._digests
+
+    def counting_digests(path, algorithms):
+        reads.append(os.path.relpath(path, tree))
+        return digests(path, algorithms)
+
+    infratest._digests = counting_digests
+    try:
+        captured = infratest.baseline_capture(tree, baseline=baseline)
+        del reads[:]
+        clean = infratest.baseline_compare(tree, baseline=baseline)
+        with open(os.path.join(tree, 'bin', 'b'), 'w') as f:
+            f.write('bin/B')
+        os.chmod(os.path.join(tree, 'etc', 'd'), 0o600)
+        os.remove(os.path.join(tree, 'bin', 'c'))
+        os.remove(os.path.join(tree, 'bin', 'link'))
+        os.symlink('b', os.path.join(tree, 'bin', 'link'))
+        _standup_file_exists(os.path.join(tree, 'etc', 'f'))
+        changed = infratest.baseline_compare(tree, baseline=baseline, details=True)
+        recorded = infratest._Baseline(baseline)
+        paths = [entry.path for entry in recorded]
+        recorded.close()
+        other = infratest.baseline_compare(os.path.join(tree, 'bin'),
+                                           baseline=baseline)
+    finally:
+        infratest._digests = digests
+        shutil.rmtree(root)
+    nose.tools.eq_(captured, {'Baseline': baseline, 'Files': 8})
+    nose.tools.eq_(paths, ['bin', 'bin/a', 'bin/b', 'bin/c', 'bin/link',
+                           'etc', 'etc/d', 'etc/e'])
+    nose.tools.eq_(clean, {'Pass': 8, 'Fail': 0, 'Added': 0, 'Removed': 0,
+                           'Modified': 0})
+    nose.tools.eq_(changed['Failed'], [
+        tree + '/bin/b modified: content',
+        tree + '/bin/c removed',
+        tree + '/bin/link modified: content',
+        tree + '/etc/d modified: mode',
+        tree + '/etc/f added'])
+    nose.tools.eq_(changed['Totals'], {'Pass': 4, 'Fail': 5, 'Added': 1,
+                                       'Removed': 1, 'Modified': 3})
+    nose.tools.eq_(reads, ['bin/b', 'etc/d'])
+    nose.tools.eq_(other, (False, 'baseline {0} was captured for {1}, not {1}/bin'.format(
+        baseline, tree)))